@@ -0,0 +1,444 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import queue
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import docker
+import requests
+
+
+# Fake of the docker client, so the benchmark runs on any Linux box without Docker.
+# Containers take start_delay seconds to run and their web server answers after ready_delay
+class FakeContainer(object):
+    def __init__(self, client, name, image, ports):
+        self.client = client
+        self.name = name
+        self.id = f'{name}-{time.time_ns()}'
+        self.status = 'running'
+        self.attrs = {'Config': {'Image': image},
+                      'State': {'StartedAt': datetime.now(timezone.utc).isoformat()}}
+        self.ports = ports
+        self.archives = [] # (path, tar data) copied by put_archive
+        self.stopped = threading.Event()
+        self.servers = []
+
+    def start(self):
+        time.sleep(self.client.start_delay)
+        self.client.add_container(self)
+        for host_ip, host_port in self.ports.values():
+            timer = threading.Timer(self.client.ready_delay, self.serve, (host_port,))
+            timer.daemon = True
+            timer.start()
+
+    def put_archive(self, path, data):
+        self.archives.append((path, data))
+        return True
+
+    def serve(self, host_port):
+        if self.stopped.is_set():
+            return
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b'Lab ready')
+            def log_message(self, *args):
+                pass
+        try:
+            server = ThreadingHTTPServer(('127.0.0.1', host_port), Handler)
+        except OSError as e:
+            print(f'Fake container {self.name} cannot listen on port {host_port}: {e}')
+            return
+        self.servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self, **kwargs):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.status = 'exited'
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.client.remove_container(self)
+
+    def remove(self, **kwargs):
+        self.stop()
+
+    def reload(self):
+        pass
+
+    def logs(self, stream=False, follow=False, timestamps=False, **kwargs):
+        line = f'{datetime.now(timezone.utc).isoformat()} Lab started\n'.encode()
+        if not stream:
+            return line
+        def generate():
+            yield line
+            if follow:
+                self.stopped.wait()
+        return generate()
+
+class FakeContainers(object):
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, image, name=None, ports=None, **kwargs):
+        return FakeContainer(self.client, name, image, ports or {})
+
+    def run(self, image, name=None, ports=None, **kwargs):
+        container = self.create(image, name, ports)
+        container.start()
+        return container
+
+    def get(self, name):
+        with self.client.lock:
+            container = self.client.running.get(name)
+        if container is None:
+            raise docker.errors.NotFound(f'No such container: {name}')
+        return container
+
+    def list(self, **kwargs):
+        with self.client.lock:
+            return list(self.client.running.values())
+
+class FakeVolume(object):
+    def __init__(self, volumes, name, labels):
+        self.volumes = volumes
+        self.name = name
+        self.attrs = {'Labels': labels or {}}
+
+    def remove(self, **kwargs):
+        self.volumes.pop(self.name, None)
+
+class FakeVolumes(object):
+    def __init__(self):
+        self.volumes = {}
+
+    def get(self, name):
+        if name not in self.volumes:
+            raise docker.errors.NotFound(f'No such volume: {name}')
+        return self.volumes[name]
+
+    def create(self, name, labels=None, **kwargs):
+        return self.volumes.setdefault(name, FakeVolume(self.volumes, name, labels))
+
+    def list(self, filters=None, **kwargs):
+        label = (filters or {}).get('label')
+        return [v for v in list(self.volumes.values()) if label is None or label in v.attrs['Labels']]
+
+class FakeDockerClient(object):
+    def __init__(self, start_delay, ready_delay):
+        self.start_delay = start_delay
+        self.ready_delay = ready_delay
+        self.lock = threading.Lock()
+        self.running = {}
+        self.subscribers = []
+        self.containers = FakeContainers(self)
+        self.volumes = FakeVolumes()
+
+    def add_container(self, container):
+        with self.lock:
+            self.running[container.name] = container
+        self.emit('start', container)
+
+    def remove_container(self, container):
+        with self.lock:
+            if self.running.get(container.name) is container:
+                del self.running[container.name]
+        self.emit('die', container)
+
+    def emit(self, action, container):
+        event = {
+            'Type': 'container',
+            'Action': action,
+            'id': container.id,
+            'time': int(time.time()),
+            'Actor': {'ID': container.id, 'Attributes': {
+                'name': container.name, 'image': container.attrs['Config']['Image']}},
+        }
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            events.put(event)
+
+    def events(self, **kwargs):
+        events = queue.Queue()
+        with self.lock:
+            self.subscribers.append(events)
+        def generate():
+            while True:
+                yield events.get()
+        return generate()
+
+    def close(self):
+        pass
+
+
+class FakeCamera(object):
+    # Fake MJPEG webcam, counts the connections to check that the relay reads it once
+    def __init__(self, port, fps):
+        self.connections = 0
+        camera = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                camera.connections += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+                self.end_headers()
+                try:
+                    while True:
+                        frame = b'\xff\xd8' + os.urandom(20000).replace(b'\xff', b'\x00') + b'\xff\xd9'
+                        self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+                        time.sleep(1 / fps)
+                except OSError: # the relay closed the connection
+                    pass
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+def summarize(latencies, errors, elapsed):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'rps': len(latencies) / elapsed if elapsed else None,
+    }
+
+class TestClientStudent(object):
+    # Simulated student using the Flask test client (in process, no network)
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, url, params=None):
+        return self.client.get(url, query_string=params).status_code
+
+    def post(self, url, data):
+        return self.client.post(url, data=data).status_code
+
+    def stream(self, url, frames):
+        # Read some frames of a MJPEG stream and leave, the students run in threads
+        response = self.client.get(url, buffered=False, environ_overrides={'wsgi.multithread': True})
+        for index, frame in enumerate(response.response):
+            if index + 1 == frames:
+                break
+        response.close()
+        return response.status_code
+
+class HttpStudent(object):
+    # Simulated student using real HTTP requests against a threaded server
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def get(self, url, params=None):
+        return self.session.get(self.base_url + url, params=params, allow_redirects=False).status_code
+
+    def post(self, url, data):
+        return self.session.post(self.base_url + url, data=data, allow_redirects=False).status_code
+
+    def stream(self, url, frames):
+        with self.session.get(self.base_url + url, stream=True, timeout=10) as response:
+            received = 0
+            for chunk in response.iter_content(64 * 1024):
+                received += chunk.count(b'--in4labsframe')
+                if received >= frames:
+                    break
+            return response.status_code
+
+def run_phase(students, rounds, request_fn, prepare_fn=None):
+    # All the students send their requests at the same time, rounds requests each.
+    # prepare_fn runs before each request and is not measured
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    def run_student(index):
+        nonlocal errors
+        for round_index in range(rounds):
+            if prepare_fn is not None:
+                prepare_fn(index, round_index)
+            start_time = time.perf_counter()
+            try:
+                ok = request_fn(index, round_index) < 500
+            except Exception as e:
+                print(f'Request error: {e}')
+                ok = False
+            latency = (time.perf_counter() - start_time) * 1000
+            with lock:
+                latencies.append(latency)
+                errors += not ok
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(students)) as executor:
+        list(executor.map(run_student, range(len(students))))
+    return latencies, errors, time.perf_counter() - start_time
+
+def run_benchmark(args):
+    fake_client = FakeDockerClient(args.start_delay, args.ready_delay)
+    docker.from_env = lambda *a, **kw: fake_client
+
+    # Use a new database, unless another one is given
+    tmp_dir = tempfile.mkdtemp(prefix='in4labs_benchmark_')
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{tmp_dir}/benchmark.db'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from in4labs_app import app, db, cache, server_name, get_registry
+    from in4labs_app.app_bp.models import Booking
+    from in4labs_app.auth.models import User
+    from werkzeug.security import generate_password_hash
+
+    app.config['WTF_CSRF_ENABLED'] = False # the simulated students don't parse the forms
+    if args.cam_frames:
+        # All the students watch the webcam of the mounting through the relay, as admins
+        from in4labs_app import labs_registry
+        camera = FakeCamera(args.cam_port, args.cam_fps)
+        labs_config = dict(labs_registry.config_module.Config.labs_config)
+        labs_config['mountings'] = [dict(mounting, cam_url=f'http://127.0.0.1:{args.cam_port}/Mjpeg')
+                                    for mounting in labs_config['mountings']]
+        labs_registry.registry = labs_registry.LabsRegistry(labs_config)
+        app.config['CAM_RELAY'] = True
+    lab = get_registry().lab_list[0]
+    lab_name = lab['lab_name']
+    lab_duration = lab['mounting']['duration']
+
+    # Same password for all the students, so the hash is only computed once
+    password = 'benchmark'
+    password_hash = generate_password_hash(password, app.config['PASSWORD_HASH_METHOD'])
+    emails = [f'student{i}@benchmark.in4labs' for i in range(args.students)]
+    with app.app_context():
+        cache.clear()
+        for email in emails:
+            if User.query.filter_by(email=email).first() is None:
+                db.session.add(User(email=email, password_hash=password_hash))
+        db.session.commit()
+        # The first student has a reservation for the current time slot to enter the Lab
+        now = datetime.now(timezone.utc)
+        start_dt = now.replace(minute=now.minute - now.minute % lab_duration, second=0, microsecond=0)
+        first_user = User.query.filter_by(email=emails[0]).first()
+        db.session.add(Booking(user_id=first_user.id, mounting_id=lab['mounting_id'],
+                               lab_name=lab_name, date_time=start_dt))
+        db.session.commit()
+
+    if args.mode == 'http':
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', args.port, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{args.port}'
+        students = [HttpStudent(base_url) for _ in emails]
+    else:
+        students = [TestClientStudent(app) for _ in emails]
+
+    # Free slots of the following days, a different one for each request
+    first_slot = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    def get_slot(index, round_index):
+        slot_dt = first_slot + timedelta(minutes=(index * args.rounds + round_index) * lab_duration)
+        return slot_dt.isoformat()
+
+    prefix = f'/{server_name}'
+    # Logins beyond the password hash queue are rejected (503), the students try again
+    # as a browser after Retry-After, so all of them are logged in for the next phases
+    rejected_logins = []
+    def login(index, round_index):
+        while True:
+            status_code = students[index].post(f'{prefix}/auth/login', {'email': emails[index],
+                                                                       'password': password})
+            if status_code != 503:
+                return status_code
+            rejected_logins.append(index)
+            time.sleep(0.5)
+
+    # Log out before each login, so all of them check the password
+    phases = [
+        ('auth.login', login, lambda i, r: students[i].get(f'{prefix}/auth/logout')),
+        ('app.check_slot', lambda i, r: students[i].get(
+            f'{prefix}/book/{lab_name}/check_slot', {'user_datetime': get_slot(i, r)}), None),
+        ('app.book_lab', lambda i, r: students[i].post(
+            f'{prefix}/book/{lab_name}/', {'date': get_slot(i, r)[:10], 'time': get_slot(i, r)[11:16],
+                                           'date_time': get_slot(i, r)}), None),
+        ('app.enter_lab', lambda i, r: students[i].get(f'{prefix}/enter/{lab_name}/'), None),
+    ]
+    if args.cam_frames:
+        app.config['ADMIN_EMAILS'] = emails
+        phases.append(('app.cam', lambda i, r: students[i].stream(
+            f'{prefix}/cam/{lab["mounting_id"]}/', args.cam_frames), None))
+    results = {}
+    for route, request_fn, prepare_fn in phases:
+        latencies, errors, elapsed = run_phase(students, args.rounds, request_fn, prepare_fn)
+        results[route] = summarize(latencies, errors, elapsed)
+    results['auth.login']['rejected'] = len(rejected_logins)
+    print(f'Logins rejected by the password hash queue and retried: {len(rejected_logins)}')
+    if args.cam_frames:
+        print(f'Webcam connections for {args.students * args.rounds} viewers: {camera.connections}')
+
+    if args.mode == 'http':
+        server.shutdown()
+    for container in fake_client.containers.list():
+        container.stop()
+
+    return {
+        'date': datetime.now(timezone.utc).isoformat(),
+        'mode': args.mode,
+        'students': args.students,
+        'rounds': args.rounds,
+        'start_delay': args.start_delay,
+        'ready_delay': args.ready_delay,
+        'password_hash_method': app.config['PASSWORD_HASH_METHOD'],
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'routes': results,
+    }
+
+def print_results(results):
+    print(f'\n{results["students"]} students, {results["rounds"]} requests each ({results["mode"]}):')
+    print(f'  {"route":<16} {"requests":>8} {"errors":>6} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"rps":>8}')
+    for route, stats in results['routes'].items():
+        print(f'  {route:<16} {stats["requests"]:>8} {stats["errors"]:>6} {stats["p50_ms"]:>8.1f} '
+              f'{stats["p95_ms"]:>8.1f} {stats["p99_ms"]:>8.1f} {stats["rps"]:>8.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the latency and throughput of the main routes '
+                                                 'with simulated students and a fake Docker backend.')
+    parser.add_argument('--students', type=int, default=20, help='concurrent students (default: 20)')
+    parser.add_argument('--rounds', type=int, default=5, help='requests of each student per route (default: 5)')
+    parser.add_argument('--mode', choices=['client', 'http'], default='client',
+                        help='Flask test client or HTTP requests to a threaded server (default: client)')
+    parser.add_argument('--port', type=int, default=8100, help='port of the server in http mode (default: 8100)')
+    parser.add_argument('--start-delay', type=float, default=0.5,
+                        help='seconds to run a fake container (default: 0.5)')
+    parser.add_argument('--ready-delay', type=float, default=2,
+                        help='seconds until the web server of a fake Lab container responds (default: 2)')
+    parser.add_argument('--cam-frames', type=int, default=0,
+                        help='frames of the webcam relay read by each student (default: 0, no webcam)')
+    parser.add_argument('--cam-port', type=int, default=8190, help='port of the fake webcam (default: 8190)')
+    parser.add_argument('--cam-fps', type=float, default=10, help='frames per second of the fake webcam (default: 10)')
+    parser.add_argument('--database-url', help='database to use (default: a new SQLite file)')
+    parser.add_argument('--output', help='save the results in this JSON file')
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results saved in {args.output}')
+    os._exit(0) # don't wait for the scheduler and Docker events threads
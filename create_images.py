@@ -1,76 +1,441 @@
+import argparse
+import fnmatch
+import hashlib
+import importlib.util
+import io
+import json
 import os
+import posixpath
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import docker
 
-from in4labs_app.config import Config
-
 
 labs_folder = os.path.join(os.getcwd(), 'in4labs_app', 'labs')
- 
+config_path = os.path.join(os.getcwd(), 'in4labs_app', 'config.py')
+hash_label = 'in4labs.context_hash'
+bundle_manifest_name = 'in4labs_bundle.json' # first file of the bundles, before the image files
+
 client = docker.from_env()
+print_lock = threading.Lock()
+
+def load_config():
+    # Load the config module alone, importing in4labs_app would start the app (db, scheduler)
+    spec = importlib.util.spec_from_file_location('in4labs_config', config_path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    return config.Config
+
+def log(image_name, message):
+    # Prefix the messages with the image name, builds and pulls run concurrently
+    with print_lock:
+        print(f'[{image_name}] {message}')
+
+def get_context_hash(context_path):
+    # Hash the files of the build context (paths and contents) to detect changes
+    ignore_patterns = ['.git', '__pycache__', '*.pyc']
+    dockerignore_path = os.path.join(context_path, '.dockerignore')
+    if os.path.exists(dockerignore_path):
+        with open(dockerignore_path, 'r') as f:
+            ignore_patterns += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    sha256 = hashlib.sha256()
+    for root, dirs, files in os.walk(context_path):
+        dirs[:] = sorted(d for d in dirs if not any(fnmatch.fnmatch(d, p) for p in ignore_patterns))
+        for file_name in sorted(files):
+            file_path = os.path.join(root, file_name)
+            rel_path = os.path.relpath(file_path, context_path)
+            if any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(file_name, p) for p in ignore_patterns):
+                continue
+            sha256.update(rel_path.encode())
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(65536), b''):
+                    sha256.update(block)
+    return sha256.hexdigest()
 
 # Function to create a Docker image from a Dockerfile
-def create_docker_image(image_name, dockerfile_path):
-    print(f'Creating Docker image {image_name}. Be patient, this will take a while...')
-    image, build_logs = client.images.build(
+def create_docker_image(image_name, dockerfile_path, force=False):
+    context_hash = get_context_hash(dockerfile_path)
+    try:
+        image = client.images.get(image_name)
+        if not force and image.labels.get(hash_label) == context_hash:
+            log(image_name, 'Docker image already exists and is up to date.')
+            return 'up to date'
+        log(image_name, 'Build context changed, rebuilding the Docker image.')
+    except docker.errors.ImageNotFound:
+        log(image_name, 'Creating Docker image. Be patient, this will take a while...')
+
+    build_logs = client.api.build(
         path=dockerfile_path,
         tag=image_name,
         rm=True,
+        labels={hash_label: context_hash},
+        decode=True,
     )
-    for log in build_logs: # Print the build logs for debugging purposes
-        print(log.get('stream', '').strip())
-    print(f'Docker image {image_name} created successfully.')
-
-# Create docker images if not exists
-labs = Config.labs_config['labs']
-for lab in labs:
-    lab_name = lab['lab_name']
-    lab_image_name = f'{lab_name.lower()}:latest'
+    for chunk in build_logs: # Print the build logs for debugging purposes
+        if 'error' in chunk:
+            raise docker.errors.BuildError(chunk['error'], build_logs)
+        line = chunk.get('stream', '').strip()
+        if line:
+            log(image_name, line)
+    log(image_name, 'Docker image created successfully.')
+    return 'built'
+
+def pull_docker_image(image_name, force=False):
     try:
-        client.images.get(lab_image_name)
-        print(f'Docker image {lab_image_name} already exists.')
+        client.images.get(image_name)
+        if not force:
+            log(image_name, 'Docker image already exists.')
+            return 'up to date'
     except docker.errors.ImageNotFound:
+        pass
+    log(image_name, 'Pulling Docker image. Be patient, this will take a while...')
+    repository, _, tag = image_name.partition(':')
+    for chunk in client.api.pull(repository, tag=tag or 'latest', stream=True, decode=True):
+        if 'error' in chunk:
+            raise docker.errors.APIError(chunk['error'])
+        # Skip the progress bars of each layer
+        if 'progress' not in chunk and 'status' in chunk:
+            log(image_name, chunk['status'])
+    log(image_name, 'Docker image pulled successfully.')
+    return 'pulled'
+
+def run_task(image_name, function, *args):
+    start_time = time.time()
+    try:
+        result = function(image_name, *args)
+    except Exception as e:
+        log(image_name, f'ERROR: {e}')
+        result = 'failed'
+    return image_name, result, time.time() - start_time
+
+def get_image_tasks(labs, force):
+    # One task per image, as several labs can share the same extra images
+    tasks = {}
+    for lab in labs:
+        lab_name = lab['lab_name']
+        lab_image_name = f'{lab_name.lower()}:latest'
         lab_dockerfile_path = os.path.join(labs_folder, lab_name)
-        create_docker_image(lab_image_name, lab_dockerfile_path)
-    
-    # Create or pull images in extra_containers
-    extra_containers = lab.get('extra_containers', [])
-    for container in extra_containers:
-        image_name = container['image']
-        try:
-            client.images.get(image_name)
-            print(f'Docker image {image_name} already exists.')
-        except docker.errors.ImageNotFound:
+        tasks[lab_image_name] = (create_docker_image, lab_dockerfile_path, force)
+
+        for container in lab.get('extra_containers', []):
+            image_name = container['image']
             if container['name'] == 'node-red':
                 # Create the node-red image
                 nodered_dockerfile_path = os.path.join(labs_folder, lab_name, 'node-red')
-                create_docker_image(image_name, nodered_dockerfile_path)
+                tasks[image_name] = (create_docker_image, nodered_dockerfile_path, force)
             else:
-                print(f'Pulling Docker image {image_name}. Be patient, this will take a while...')
-                client.images.pull(image_name)
-                print(f'Docker image {image_name} pulled successfully.')
-        
-        # Create network 
-        network_name = container['network']
+                tasks.setdefault(image_name, (pull_docker_image, force))
+    return tasks
+
+def create_networks_and_volumes(labs):
+    for lab in labs:
+        for container in lab.get('extra_containers', []):
+            # Create network
+            network_name = container['network']
+            try:
+                client.networks.get(network_name)
+                print(f'Docker network {network_name} already exists.')
+            except docker.errors.NotFound:
+                print(f'Creating Docker network {network_name}.')
+                client.networks.create(network_name)
+                print(f'Docker network {network_name} created successfully.')
+
+            # Create volumes
+            volumes = container.get('volumes', {})
+            for volume_name, volume in volumes.items():
+                # Check if volume_name not starts with '/', so it is a volume and not a path
+                if not volume_name.startswith('/'):
+                    try:
+                        client.volumes.get(volume_name)
+                        print(f'Docker volume {volume_name} already exists.')
+                    except docker.errors.NotFound:
+                        print(f'Creating Docker volume {volume_name}.')
+                        client.volumes.create(volume_name)
+                        print(f'Docker volume {volume_name} created successfully.')
+
+def provision(labs, workers, force):
+    # Build and pull the images concurrently
+    tasks = get_image_tasks(labs, force)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_task, image_name, *task) for image_name, task in tasks.items()]
+        results = [future.result() for future in futures]
+
+    create_networks_and_volumes(labs)
+
+    print('\nSummary:')
+    for image_name, result, secs in results:
+        print(f'  {image_name:<40} {result:<12} {secs:7.1f}s')
+    print(f'Total time: {time.time() - start_time:.1f}s')
+    return all(result != 'failed' for _, result, _ in results)
+
+
+class ChunksReader(object):
+    # File object over the chunks of a docker save, so tarfile reads them as they arrive
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if not self.chunk:
+                self.chunk = memoryview(next(self.chunks, b''))
+                if not self.chunk:
+                    break
+            part = self.chunk[:size] if size > 0 else self.chunk
+            self.chunk = self.chunk[len(part):]
+            parts.append(part)
+            if size > 0:
+                size -= len(part)
+        return b''.join(parts)
+
+class HashingReader(object):
+    # Compute the SHA-256 of a file while it is copied
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+def is_safe_path(path):
+    return not posixpath.isabs(path) and '..' not in path.split('/')
+
+def resolve_link(path, link_name):
+    return posixpath.normpath(posixpath.join(posixpath.dirname(path), link_name))
+
+def save_image(image_name, files_folder, files, links):
+    # Extract the docker save of an image to the folder, skipping the files (layers) already
+    # saved by other images. Returns the entry of the image in the bundle manifest
+    image = client.images.get(image_name)
+    log(image_name, 'Saving Docker image.')
+    save_manifest = None
+    with tarfile.open(fileobj=ChunksReader(image.save(named=True)), mode='r|') as tar:
+        for member in tar:
+            if member.name == 'manifest.json':
+                save_manifest = json.load(tar.extractfile(member))
+            elif not is_safe_path(member.name) or member.name in files or member.name in links:
+                continue
+            elif member.issym():
+                links[member.name] = resolve_link(member.name, member.linkname)
+            elif member.isfile():
+                file_path = os.path.join(files_folder, *member.name.split('/'))
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                reader = HashingReader(tar.extractfile(member))
+                with open(file_path, 'wb') as f:
+                    for block in iter(lambda: reader.read(1024 * 1024), b''):
+                        f.write(block)
+                files[member.name] = {'sha256': reader.sha256.hexdigest(), 'size': member.size}
+    if not save_manifest:
+        raise ValueError(f'manifest.json not found in the docker save of {image_name}')
+
+    # The layer files are in the order of the layers of the image (diff ids)
+    diff_ids = image.attrs['RootFS'].get('Layers', [])
+    layer_paths = save_manifest[0]['Layers']
+    if len(diff_ids) != len(layer_paths):
+        raise ValueError(f'The docker save of {image_name} does not match its layers')
+    log(image_name, 'Docker image saved successfully.')
+    return {
+        'name': image_name,
+        'id': image.id,
+        'repo_digests': image.attrs.get('RepoDigests', []),
+        'config': save_manifest[0]['Config'],
+        'layers': [{'path': path, 'diff_id': diff_id} for path, diff_id in zip(layer_paths, diff_ids)],
+    }
+
+def export_images(labs, bundle_path):
+    # Save all the images of the Labs into one compressed bundle. Shared layers (base images)
+    # are stored once and every file has its SHA-256 in the manifest of the bundle
+    start_time = time.time()
+    image_names = list(get_image_tasks(labs, False))
+    files = {} # path in the bundle -> {'sha256', 'size'}
+    links = {} # path in the bundle -> path of the file
+    with tempfile.TemporaryDirectory() as files_folder:
+        images = [save_image(image_name, files_folder, files, links) for image_name in image_names]
+        manifest = json.dumps({'created': time.time(), 'images': images, 'files': files, 'links': links},
+                              indent=2).encode()
+
+        print(f'Writing the bundle {bundle_path}...')
+        with tarfile.open(bundle_path, 'w:gz', compresslevel=6) as bundle:
+            info = tarfile.TarInfo(bundle_manifest_name)
+            info.size = len(manifest)
+            info.mtime = time.time()
+            bundle.addfile(info, io.BytesIO(manifest))
+            for path in sorted(files):
+                bundle.add(os.path.join(files_folder, *path.split('/')), arcname=path)
+            for path, target in sorted(links.items()):
+                info = tarfile.TarInfo(path)
+                info.type = tarfile.SYMTYPE
+                info.linkname = posixpath.relpath(target, posixpath.dirname(path))
+                bundle.addfile(info)
+
+    saved_size = sum(f['size'] for f in files.values())
+    print('\nSummary:')
+    for image in images:
+        print(f'  {image["name"]:<40} {len(image["layers"]):3} layers')
+    print(f'Images: {len(images)}, files: {len(files)} ({saved_size / 1e6:.1f} MB), '
+          f'bundle: {os.path.getsize(bundle_path) / 1e6:.1f} MB')
+    print(f'Total time: {time.time() - start_time:.1f}s')
+    return True
+
+def get_local_layer_chains():
+    # Layers of the local images, identified by their diff ids and those of the layers below
+    chains = set()
+    for image in client.images.list(all=True):
+        diff_ids = tuple(image.attrs['RootFS'].get('Layers', []))
+        chains.update(diff_ids[:i + 1] for i in range(len(diff_ids)))
+    return chains
+
+def tag_image(image, image_name):
+    if image_name not in image.tags:
+        repository, _, tag = image_name.partition(':')
+        image.tag(repository, tag or 'latest')
+
+def write_load_tar(bundle, manifest, missing, needed, pipe, errors):
+    # Stream the files needed by the missing images from the bundle to docker load, checking
+    # their SHA-256. After an error an invalid tar header is sent, so docker load fails and
+    # loads nothing
+    try:
+        with tarfile.open(fileobj=pipe, mode='w|') as load_tar:
+            load_manifest = json.dumps([{'Config': image['config'], 'RepoTags': [image['name']],
+                                         'Layers': [layer['path'] for layer in image['layers']]}
+                                        for image in missing]).encode()
+            info = tarfile.TarInfo('manifest.json')
+            info.size = len(load_manifest)
+            load_tar.addfile(info, io.BytesIO(load_manifest))
+            for member in bundle:
+                if member.name not in needed:
+                    continue
+                if member.issym():
+                    load_tar.addfile(member)
+                else:
+                    reader = HashingReader(bundle.extractfile(member))
+                    load_tar.addfile(member, reader)
+                    if reader.sha256.hexdigest() != manifest['files'][member.name]['sha256']:
+                        raise ValueError(f'{member.name} is corrupted (SHA-256 does not match)')
+                needed.discard(member.name)
+            if needed:
+                raise ValueError(f'Files missing in the bundle: {", ".join(sorted(needed))}')
+    except Exception as e:
+        errors.append(e)
         try:
-            client.networks.get(network_name)
-            print(f'Docker network {network_name} already exists.')
-        except docker.errors.NotFound:
-            print(f'Creating Docker network {network_name}.')
-            client.networks.create(network_name)
-            print(f'Docker network {network_name} created successfully.')
-
-        # Create volumes
-        volumes = container.get('volumes', {})
-        for volume_name, volume in volumes.items():
-            # Check if volume_name not starts with '/', so it is a volume and not a path
-            if not volume_name.startswith('/'):
+            pipe.write(b'\xff' * tarfile.BLOCKSIZE)
+        except OSError: # docker load already failed
+            pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+def import_images(labs, bundle_path):
+    # Load the images of a bundle that are missing in this device. Only the files of the layers
+    # that are not already here are sent to Docker, and the images are checked after loading
+    start_time = time.time()
+    results = []
+    with tarfile.open(bundle_path, 'r|gz') as bundle:
+        member = bundle.next()
+        if member is None or member.name != bundle_manifest_name:
+            raise ValueError(f'{bundle_path} is not an In4Labs image bundle')
+        manifest = json.load(bundle.extractfile(member))
+
+        missing = []
+        for image in manifest['images']:
+            try:
+                tag_image(client.images.get(image['id']), image['name'])
+                log(image['name'], 'Docker image already exists.')
+                results.append((image['name'], 'up to date'))
+            except docker.errors.ImageNotFound:
+                missing.append(image)
+
+        required = set(get_image_tasks(labs, False))
+        for image_name in sorted(required - {image['name'] for image in manifest['images']}):
+            log(image_name, 'ERROR: Docker image not found in the bundle.')
+            results.append((image_name, 'failed'))
+
+        if missing:
+            local_chains = get_local_layer_chains()
+            needed = set()
+            for image in missing:
+                needed.add(image['config'])
+                diff_ids = tuple(layer['diff_id'] for layer in image['layers'])
+                for i, layer in enumerate(image['layers']):
+                    if diff_ids[:i + 1] not in local_chains:
+                        needed.add(layer['path'])
+            needed.update([manifest['links'][path] for path in needed if path in manifest['links']])
+            load_size = sum(manifest['files'][path]['size'] for path in needed if path in manifest['files'])
+            print(f'Loading {len(missing)} Docker images ({load_size / 1e6:.1f} MB of layers)...')
+
+            read_fd, write_fd = os.pipe()
+            errors = []
+            writer = threading.Thread(target=write_load_tar, args=(bundle, manifest, missing, needed,
+                                                                   os.fdopen(write_fd, 'wb'), errors))
+            writer.start()
+            try:
+                with os.fdopen(read_fd, 'rb') as pipe:
+                    for chunk in client.api.load_image(pipe):
+                        if 'error' in chunk:
+                            raise docker.errors.APIError(chunk['error'])
+                        if chunk.get('stream', '').strip():
+                            print(chunk['stream'].strip())
+            except docker.errors.APIError as e:
+                errors.append(e)
+            writer.join()
+
+            for image in missing:
+                # The id of an image is the SHA-256 of its config, which has the diff ids of its layers
                 try:
-                    client.volumes.get(volume_name)
-                    print(f'Docker volume {volume_name} already exists.')
-                except docker.errors.NotFound:
-                    print(f'Creating Docker volume {volume_name}.')
-                    client.volumes.create(volume_name)
-                    print(f'Docker volume {volume_name} created successfully.')
-
-print('All Docker images and networks are ready.')
+                    loaded_image = client.images.get(image['id'])
+                    loaded = loaded_image.attrs['RootFS'].get('Layers', []) == \
+                        [layer['diff_id'] for layer in image['layers']]
+                    tag_image(loaded_image, image['name'])
+                except docker.errors.ImageNotFound:
+                    loaded = False
+                if loaded:
+                    log(image['name'], 'Docker image loaded successfully.')
+                else:
+                    log(image['name'], f'ERROR: Docker image not loaded. {" ".join(map(str, errors))}')
+                results.append((image['name'], 'loaded' if loaded else 'failed'))
+
+    create_networks_and_volumes(labs)
+
+    print('\nSummary:')
+    for image_name, result in results:
+        print(f'  {image_name:<40} {result:<12}')
+    print(f'Total time: {time.time() - start_time:.1f}s')
+    return all(result != 'failed' for _, result in results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the Docker images, networks and volumes of the Labs.')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of images built or pulled at the same time (default: 2)')
+    parser.add_argument('--force', action='store_true',
+                        help='rebuild and pull all the images, even if they are up to date')
+    parser.add_argument('--export', metavar='BUNDLE',
+                        help='create the images and save them into a bundle (.tar.gz) for other devices')
+    parser.add_argument('--import', metavar='BUNDLE', dest='import_bundle',
+                        help='load the missing images from a bundle instead of building and pulling them')
+    args = parser.parse_args()
+
+    labs = load_config().labs_config['labs']
+    if args.import_bundle:
+        ready = import_images(labs, args.import_bundle)
+    else:
+        ready = provision(labs, args.workers, args.force)
+        if ready and args.export:
+            ready = export_images(labs, args.export)
+    if ready:
+        print('All Docker images and networks are ready.')
+    else:
+        print('Some Docker images could not be created, check the logs above.')
+        sys.exit(1)
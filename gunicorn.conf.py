@@ -0,0 +1,29 @@
+import os
+import shutil
+from tempfile import gettempdir
+
+from prometheus_client import multiprocess
+
+
+# Gunicorn settings, loaded from the working directory (see the systemd service in the README)
+
+# Threaded workers: a burst of logins only takes the threads of the password hash queue
+# (PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE, the next ones get a 503) and the Lab proxy
+# and the webcam relay keep a thread per open connection
+worker_class = 'gthread'
+threads = 16
+
+# Folder of the metrics of all the workers, shared with in4labs_app.metrics
+# (per instance, see IN4LABS_SERVER_NAME in in4labs_app/config.py)
+instance_name = os.environ.get('IN4LABS_SERVER_NAME')
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(
+    gettempdir(), f'in4labs_{instance_name}_metrics' if instance_name else 'in4labs_metrics'))
+
+def on_starting(server):
+    # The metrics of a previous run are not valid
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+def child_exit(server, worker):
+    # Leave out the gauges of dead workers
+    multiprocess.mark_process_dead(worker.pid)
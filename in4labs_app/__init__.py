@@ -1,24 +1,34 @@
 import os
 
 from flask import Flask
+from jinja2 import ChoiceLoader, FileSystemLoader, FileSystemBytecodeCache
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 from flask_caching import Cache
+from sqlalchemy import event
 
 from .config import Config
+from .labs_registry import get_registry, reload_registry_if_changed
 
 # Set the base directory to the current file's directory
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 # Get variables from config
-server_name = Config.labs_config['server_name']
-mountings = Config.labs_config['mountings']
-labs = Config.labs_config['labs']
+server_name = get_registry().server_name
 
 app = Flask(__name__, template_folder='templates', static_folder='static',
             static_url_path=(f'/{server_name}/static/'))
 app.config.from_object(Config)
 
+# Serve the lab instructions from their lab folders (e.g. 'lab_1/instructions.html').
+# Compiled templates are cached on disk and reloaded when the files change
+app.jinja_loader = ChoiceLoader([
+    FileSystemLoader(os.path.join(basedir, 'templates')),
+    FileSystemLoader(os.path.join(basedir, 'labs')),
+])
+os.makedirs(Config.JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(Config.JINJA_CACHE_DIR))
+
 cache = Cache(app)
 
 # Init login
@@ -30,24 +40,29 @@ login.login_view = 'auth.login'
 db = SQLAlchemy()
 db.init_app(app)
 
-# Create db if not exists
-from .app_bp.models import Booking
+# SQLite settings: readers don't block behind writers (WAL) and writers wait instead of failing
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute(f'PRAGMA busy_timeout={Config.SQLITE_BUSY_TIMEOUT}')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', set_sqlite_pragmas)
+
+# Prometheus metrics of the requests and db queries, served in /metrics
+from . import metrics
+with app.app_context():
+    metrics.init_app(app, db.engine)
+
+# Create db if not exists and upgrade it
+from .app_bp.models import Booking, LabSession
 from .auth.models import User
-if not os.path.exists(os.path.join(basedir, 'in4labs.db')): 
-    print('Creating database...')
-    with app.app_context():
-        db.create_all() # create tables in db
-
-# Copy html files with lab instructions to templates folder
-for lab in labs:
-    lab_name = lab['lab_name']
-    html_path = os.path.join(basedir, 'labs', lab_name, 'instructions.html')
-    if os.path.exists(html_path):
-        html_dest = os.path.join(basedir, 'templates', f'{lab_name}_instructions.html')
-        with open(html_path, 'r') as f:
-            html_content = f.read()
-        with open(html_dest, 'w') as f:
-            f.write(html_content)
+from .database import upgrade_db
+with app.app_context():
+    upgrade_db()
 
 # Register blueprints - moved to the end to avoid circular imports
 def register_blueprints():
@@ -55,4 +70,13 @@ def register_blueprints():
     app.register_blueprint(app_bp.bp, url_prefix=f'/{server_name}')
     app.register_blueprint(auth.bp, url_prefix=f'/{server_name}/auth')
 
-register_blueprints()
\ No newline at end of file
+register_blueprints()
+
+# Apply the changes of the labs configuration without restarting gunicorn
+@app.before_request
+def reload_labs_config():
+    reload_registry_if_changed(app.config['LABS_RELOAD_INTERVAL'])
+
+# Start and stop the containers of the booked time slots
+from .app_bp.scheduler import LabScheduler
+LabScheduler(app).start()
@@ -0,0 +1,100 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from sqlalchemy import func
+
+from in4labs_app import db
+from in4labs_app.database import insert_or_add
+from .models import Booking, BookingArchive, LabSession, UsageRollup
+
+
+usage_counters = ('bookings', 'entered', 'starts', 'start_seconds', 'sessions', 'session_seconds')
+usage_fields = ('start', 'lab_name', 'mounting_id', 'bookings', 'entered', 'no_shows', 'avg_start_seconds',
+                'avg_session_minutes') # of the report
+
+
+def get_rolled_up_until():
+    # Hours are added whole and in order, the next one to add is after the last stored one
+    last_hour = db.session.query(func.max(UsageRollup.start)).filter(UsageRollup.period == 'hour').scalar()
+    return last_hour + timedelta(hours=1) if last_hour else None
+
+def add_usage(rollups, lab_name, mounting_id, date_time, entered, started_at=None, ready_at=None,
+              entered_at=None, stopped_at=None):
+    hour = date_time.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    for key in (('hour', hour, lab_name, mounting_id), ('day', day, lab_name, mounting_id)):
+        usage = rollups[key]
+        usage['bookings'] += 1
+        usage['entered'] += entered
+        if started_at and ready_at:
+            usage['starts'] += 1
+            usage['start_seconds'] += (ready_at - started_at).total_seconds()
+        if entered_at and stopped_at:
+            usage['sessions'] += 1
+            usage['session_seconds'] += (stopped_at - entered_at).total_seconds()
+
+def save_usage(rollups):
+    for (period, start, lab_name, mounting_id), usage in rollups.items():
+        insert_or_add(UsageRollup, dict(usage, period=period, start=start, lab_name=lab_name,
+                                        mounting_id=mounting_id), ['period', 'start', 'lab_name', 'mounting_id'])
+    db.session.commit()
+
+def rollup_usage(until_dt):
+    # Add the bookings of the time slots before until_dt (naive UTC, whole hour) and their
+    # sessions to the usage rollups, a day at a time. The first time, the archived bookings too
+    added = 0
+    from_dt = get_rolled_up_until()
+    if from_dt is None:
+        rollups = defaultdict(lambda: dict.fromkeys(usage_counters, 0))
+        archived = db.session.query(BookingArchive.lab_name, BookingArchive.mounting_id, BookingArchive.date_time,
+                                    BookingArchive.entered).filter(BookingArchive.date_time < until_dt).all()
+        for row in archived:
+            add_usage(rollups, row.lab_name, row.mounting_id, row.date_time, row.entered)
+        save_usage(rollups)
+        added += len(archived)
+        from_dt = get_rolled_up_until() or db.session.query(func.min(Booking.date_time)).scalar()
+        if from_dt is None:
+            return added
+        from_dt = from_dt.replace(minute=0, second=0, microsecond=0)
+
+    while from_dt < until_dt:
+        to_dt = min(from_dt + timedelta(days=1), until_dt)
+        rows = db.session.query(
+            Booking.lab_name, Booking.mounting_id, Booking.date_time, LabSession.started_at,
+            LabSession.ready_at, LabSession.entered_at, LabSession.stopped_at
+        ).outerjoin(LabSession, LabSession.booking_id == Booking.id).filter(
+            Booking.date_time >= from_dt,
+            Booking.date_time < to_dt
+        ).all()
+        rollups = defaultdict(lambda: dict.fromkeys(usage_counters, 0))
+        for row in rows:
+            add_usage(rollups, row.lab_name, row.mounting_id, row.date_time, row.entered_at is not None,
+                      row.started_at, row.ready_at, row.entered_at, row.stopped_at)
+        save_usage(rollups)
+        added += len(rows)
+        from_dt = to_dt
+    return added
+
+def get_usage_row(usage):
+    return {
+        'start': usage.start.isoformat() + 'Z',
+        'lab_name': usage.lab_name,
+        'mounting_id': usage.mounting_id,
+        'bookings': usage.bookings,
+        'entered': usage.entered,
+        'no_shows': usage.bookings - usage.entered,
+        'avg_start_seconds': round(usage.start_seconds / usage.starts, 1) if usage.starts else None,
+        'avg_session_minutes': round(usage.session_seconds / usage.sessions / 60, 1) if usage.sessions else None,
+    }
+
+def get_usage_totals(usages):
+    # Totals of each lab in the range
+    totals = {}
+    for usage in usages:
+        total = totals.setdefault(usage.lab_name, UsageRollup(
+            lab_name=usage.lab_name, mounting_id=usage.mounting_id, start=usage.start,
+            **dict.fromkeys(usage_counters, 0)))
+        for name in usage_counters:
+            setattr(total, name, getattr(total, name) + getattr(usage, name))
+        total.start = min(total.start, usage.start)
+    return [get_usage_row(total) for total in totals.values()]
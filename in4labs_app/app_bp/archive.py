@@ -0,0 +1,38 @@
+from sqlalchemy import or_
+
+from in4labs_app import db
+from .models import Booking, BookingArchive, LabSession
+
+
+def archive_bookings(before_dt, batch_size=500):
+    # Move the bookings of time slots before before_dt (and their stopped sessions) to the
+    # booking_archive table. In batches, so the app writes only wait a short time for the
+    # database lock
+    archived = 0
+    while True:
+        rows = db.session.query(Booking, LabSession.entered_at).outerjoin(
+            LabSession, LabSession.booking_id == Booking.id
+        ).filter(
+            Booking.date_time < before_dt,
+            or_(LabSession.id.is_(None), LabSession.status == 'stopped')
+        ).order_by(Booking.id).limit(batch_size).all()
+        if not rows:
+            return archived
+
+        archive_rows = []
+        for booking, entered_at in rows:
+            archive_rows.append({
+                'booking_id': booking.id,
+                'user_id': booking.user_id,
+                'mounting_id': booking.mounting_id,
+                'lab_name': booking.lab_name,
+                'date_time': booking.date_time,
+                'entered': entered_at is not None,
+            })
+        booking_ids = [row['booking_id'] for row in archive_rows]
+
+        db.session.execute(db.insert(BookingArchive), archive_rows)
+        LabSession.query.filter(LabSession.booking_id.in_(booking_ids)).delete(synchronize_session=False)
+        Booking.query.filter(Booking.id.in_(booking_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        archived += len(rows)
@@ -0,0 +1,152 @@
+import codecs
+import csv
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy.exc import IntegrityError
+
+from in4labs_app import db
+from in4labs_app.auth.models import User
+from .models import Booking
+from .utils import get_lab, bump_slots_version
+
+
+max_rows = 5000 # time slots of a bulk booking
+
+
+def get_row(line, email, lab_name, date_time=None, message=None):
+    # A time slot to book, with an error message if it can't be booked
+    return {'line': line, 'email': email, 'lab_name': lab_name, 'date_time': date_time,
+            'status': 'error' if message else None, 'message': message}
+
+def expand_rule(lab_name, email, weekdays, start_date, weeks, start_time, end_time, tz_name):
+    # Time slots from start_time to end_time of the weekdays in the local time of tz_name,
+    # so they keep the same hour after a daylight saving time change
+    lab = get_lab(lab_name)
+    if lab is None:
+        return [get_row(1, email, lab_name, message='Lab not found.')]
+    try:
+        tz = ZoneInfo(tz_name or 'UTC')
+    except (ZoneInfoNotFoundError, ValueError):
+        tz = timezone.utc
+    lab_duration = lab['mounting']['duration']
+    rows = []
+    for week in range(weeks):
+        for weekday in sorted(weekdays):
+            day = start_date + timedelta(days=(weekday - start_date.weekday()) % 7 + 7 * week)
+            slot_dt = datetime.combine(day, start_time, tzinfo=tz)
+            slot_dt -= timedelta(minutes=slot_dt.minute % lab_duration)
+            end_dt = datetime.combine(day, end_time, tzinfo=tz)
+            while slot_dt < end_dt:
+                if len(rows) == max_rows:
+                    return rows + [get_row(len(rows) + 1, email, lab_name,
+                                           message=f'More than {max_rows} time slots.')]
+                rows.append(get_row(len(rows) + 1, email, lab_name, slot_dt.astimezone(timezone.utc)))
+                slot_dt += timedelta(minutes=lab_duration)
+    return rows
+
+def read_csv(stream):
+    # Rows with email,lab_name,date_time, read from the uploaded file without loading it whole
+    reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8-sig'))
+    rows = []
+    for row in reader:
+        line = reader.line_num
+        email = (row.get('email') or '').strip()
+        lab_name = (row.get('lab_name') or '').strip()
+        if len(rows) == max_rows:
+            rows.append(get_row(line, email, lab_name, message=f'More than {max_rows} time slots.'))
+            break
+        try:
+            date_time = datetime.fromisoformat((row.get('date_time') or '').strip())
+        except ValueError:
+            rows.append(get_row(line, email, lab_name, message='Invalid date/time.'))
+            continue
+        if date_time.tzinfo is None:
+            date_time = date_time.replace(tzinfo=timezone.utc)
+        rows.append(get_row(line, email, lab_name, date_time.astimezone(timezone.utc)))
+    return rows
+
+def validate_rows(rows):
+    # Users, labs, time slots and duplicates of the batch, without querying the bookings
+    emails = {row['email'] for row in rows if row['status'] is None}
+    users = dict(db.session.query(User.email, User.id).filter(User.email.in_(emails))) if emails else {}
+    now = datetime.now(timezone.utc)
+    slots = set()
+    valid_rows = []
+    for row in rows:
+        if row['status'] is not None:
+            continue
+        lab = get_lab(row['lab_name'])
+        lab_duration = lab['mounting']['duration'] if lab else None
+        if lab is None:
+            row['status'], row['message'] = 'error', 'Lab not found.'
+        elif row['email'] not in users:
+            row['status'], row['message'] = 'error', 'User not registered.'
+        elif row['date_time'].minute % lab_duration or row['date_time'].second:
+            row['status'], row['message'] = 'error', f'Time slots start every {lab_duration} minutes.'
+        elif row['date_time'] < now:
+            row['status'], row['message'] = 'error', 'The time slot is outdated.'
+        elif (lab['mounting_id'], row['date_time']) in slots:
+            row['status'], row['message'] = 'duplicate', 'Time slot repeated in the batch.'
+        else:
+            slots.add((lab['mounting_id'], row['date_time']))
+            row['user_id'] = users[row['email']]
+            row['mounting_id'] = lab['mounting_id']
+            valid_rows.append(row)
+    return valid_rows
+
+def get_booked_slots(valid_rows):
+    # A single range query over the (mounting_id, date_time) index for the whole batch
+    mounting_ids = {row['mounting_id'] for row in valid_rows}
+    date_times = [row['date_time'] for row in valid_rows]
+    bookings = db.session.query(Booking.mounting_id, Booking.date_time).filter(
+        Booking.mounting_id.in_(mounting_ids),
+        Booking.date_time >= min(date_times),
+        Booking.date_time <= max(date_times)
+    ).all()
+    return {(str(b.mounting_id), b.date_time.replace(tzinfo=timezone.utc)) for b in bookings}
+
+def book_rows(rows, check_only=False):
+    # Book the free time slots of the rows in one transaction. If a user books one of them
+    # in the meantime, the unique index rejects the transaction and the conflicts are checked again
+    valid_rows = validate_rows(rows)
+    for attempt in range(3):
+        if not valid_rows:
+            break
+        booked = get_booked_slots(valid_rows)
+        free_rows = []
+        for row in valid_rows:
+            if (row['mounting_id'], row['date_time']) in booked:
+                row['status'], row['message'] = 'conflict', 'Already reserved.'
+            else:
+                row['status'], row['message'] = 'free' if check_only else 'booked', None
+                free_rows.append(row)
+        if check_only or not free_rows:
+            db.session.rollback()
+            break
+        try:
+            db.session.execute(db.insert(Booking), [{
+                'user_id': row['user_id'],
+                'mounting_id': row['mounting_id'],
+                'lab_name': row['lab_name'],
+                'date_time': row['date_time'],
+            } for row in free_rows])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            continue
+        for mounting_id in {row['mounting_id'] for row in free_rows}:
+            bump_slots_version(mounting_id)
+        break
+    else:
+        for row in valid_rows:
+            row['status'], row['message'] = 'error', 'Too many concurrent bookings, try again.'
+
+    return [{
+        'line': row['line'],
+        'email': row['email'],
+        'lab_name': row['lab_name'],
+        'date_time': row['date_time'].isoformat() if row['date_time'] else None,
+        'status': row['status'],
+        'message': row['message'],
+    } for row in rows]
@@ -0,0 +1,193 @@
+import threading
+import time
+from collections import deque, OrderedDict
+
+import requests
+
+
+# The webcam of each mounting is read once per worker and its frames (MJPEG) or segments (HLS)
+# are sent to all the viewers from memory
+relays = {} # mounting_id -> MjpegRelay or HlsRelay
+relays_lock = threading.Lock()
+idle_secs = 30 # stop reading the webcam after the last viewer leaves
+chunk_size = 4096 # small reads, so the frames are sent as soon as they arrive
+
+
+def is_hls(cam_url):
+    return cam_url.split('?')[0].endswith('.m3u8')
+
+def get_relay(mounting, ring_size):
+    # A new relay if the webcam URL changed in the labs configuration
+    with relays_lock:
+        relay = relays.get(mounting['id'])
+        if relay is None or relay.cam_url != mounting['cam_url']:
+            relay_class = HlsRelay if is_hls(mounting['cam_url']) else MjpegRelay
+            relay = relays[mounting['id']] = relay_class(mounting['cam_url'], ring_size)
+        return relay
+
+
+class MjpegRelay(object):
+    # A thread reads the multipart stream of the webcam while there are viewers,
+    # keeping its last frames in a ring. Slow viewers skip to the newest frame
+    boundary = 'in4labsframe'
+
+    def __init__(self, cam_url, ring_size):
+        self.cam_url = cam_url
+        self.frames = deque(maxlen=ring_size) # (number, JPEG bytes)
+        self.frame_number = 0
+        self.condition = threading.Condition()
+        self.viewers = 0
+        self.last_viewer_time = time.time()
+        self.reader = None
+
+    def start_reader(self):
+        # Called with the condition held
+        if self.reader is None:
+            self.reader = threading.Thread(target=self.read_cam, daemon=True)
+            self.reader.start()
+
+    def is_watched(self):
+        return self.viewers > 0 or time.time() - self.last_viewer_time < idle_secs
+
+    def read_cam(self):
+        while True:
+            with self.condition:
+                if not self.is_watched():
+                    self.reader = None
+                    return
+            try:
+                with requests.get(self.cam_url, stream=True, timeout=(5, 10)) as resp:
+                    resp.raise_for_status()
+                    self.read_frames(resp.iter_content(chunk_size))
+            except requests.RequestException as e:
+                print(f'Webcam {self.cam_url} not available: {e}')
+                time.sleep(1)
+
+    def read_frames(self, chunks):
+        # The JPEG images between their start and end markers, whatever the part headers
+        buffer = b''
+        for chunk in chunks:
+            buffer += chunk
+            while True:
+                start = buffer.find(b'\xff\xd8')
+                end = buffer.find(b'\xff\xd9', start + 2) if start != -1 else -1
+                if end == -1:
+                    break
+                self.add_frame(buffer[start:end + 2])
+                buffer = buffer[end + 2:]
+            if len(buffer) > 4 * 1024 * 1024: # not a MJPEG stream
+                buffer = b''
+            if not self.is_watched():
+                return
+
+    def add_frame(self, frame):
+        with self.condition:
+            self.frame_number += 1
+            self.frames.append((self.frame_number, frame))
+            self.condition.notify_all()
+
+    def iter_frames(self, deadline):
+        with self.condition:
+            self.viewers += 1
+            self.start_reader()
+        try:
+            last_number = 0
+            while time.time() < deadline:
+                with self.condition:
+                    self.condition.wait_for(lambda: self.frames and self.frames[-1][0] > last_number, timeout=10)
+                    if not self.frames or self.frames[-1][0] <= last_number:
+                        return # the webcam stopped sending
+                    last_number, frame = self.frames[-1]
+                yield (f'--{self.boundary}\r\nContent-Type: image/jpeg\r\n'
+                       f'Content-Length: {len(frame)}\r\n\r\n').encode() + frame + b'\r\n'
+        finally:
+            with self.condition:
+                self.viewers -= 1
+                self.last_viewer_time = time.time()
+
+    @property
+    def mimetype(self):
+        return f'multipart/x-mixed-replace; boundary={self.boundary}'
+
+
+class HlsRelay(object):
+    # The playlists are fetched at most once per second and each segment once, the last
+    # segments are kept in a ring for the viewers that are behind. Only the files listed
+    # in the playlists are fetched from the webcam
+    playlist_secs = 1
+
+    def __init__(self, cam_url, ring_size):
+        self.cam_url = cam_url
+        self.base_url = cam_url.split('?')[0].rsplit('/', 1)[0] + '/'
+        self.playlist_name = cam_url.split('?')[0].rsplit('/', 1)[1]
+        self.ring_size = ring_size
+        self.playlists = {} # name -> (fetch time, content)
+        self.listed = {} # playlist name -> names of the files it lists, with their query strings
+        self.segments = OrderedDict() # name -> (content type, content)
+        self.lock = threading.Lock() # one fetch at a time, the viewers waiting get its result
+
+    def get_file(self, name):
+        # Returns (content type, content) of a playlist or a segment of the webcam,
+        # None if it isn't listed in the playlists
+        name = name or self.playlist_name
+        with self.lock:
+            if not self.is_listed(name):
+                # The playlist may have been read by another worker, or a new segment listed
+                self.refresh_playlists()
+                if not self.is_listed(name):
+                    return None
+            if name.split('?')[0].endswith('.m3u8'):
+                return 'application/vnd.apple.mpegurl', self.get_playlist(name)
+            if name not in self.segments:
+                self.segments[name] = self.fetch(name)
+                while len(self.segments) > self.ring_size:
+                    self.segments.popitem(last=False)
+            return self.segments[name]
+
+    def is_listed(self, name):
+        return (name == self.playlist_name or name in self.segments
+                or any(name in names for names in self.listed.values()))
+
+    def refresh_playlists(self):
+        # The main playlist and the variant playlists it lists
+        names = [self.playlist_name]
+        for name in names:
+            self.get_playlist(name)
+            names += [n for n in self.listed.get(name, ()) if n.split('?')[0].endswith('.m3u8') and n not in names]
+
+    def get_playlist(self, name):
+        # Called with the lock held
+        fetch_time, content = self.playlists.get(name, (0, None))
+        if time.time() - fetch_time >= self.playlist_secs:
+            content = self.fetch(name)[1]
+            # Absolute URLs of the segments in the webcam are served by the relay
+            content = content.replace((self.base_url + self.get_dir(name)).encode(), b'')
+            self.playlists[name] = (time.time(), content)
+            self.listed[name] = self.get_listed(name, content)
+        return content
+
+    def get_dir(self, name):
+        # Directory of a playlist relative to the webcam URL, '' or ending with /
+        return name.split('?')[0].rpartition('/')[0] + '/' if '/' in name.split('?')[0] else ''
+
+    def get_listed(self, playlist_name, content):
+        # The URI lines and URI="..." attributes, relative to the directory of the playlist
+        prefix = self.get_dir(playlist_name)
+        names = set()
+        for line in content.decode('utf-8', 'replace').splitlines():
+            line = line.strip()
+            if line.startswith('#'):
+                uris = [part.split('"')[1] for part in line.split('URI=')[1:] if part.startswith('"')]
+            else:
+                uris = [line] if line else []
+            for uri in uris:
+                # Only the files under the webcam URL, not other hosts or parent directories
+                if '://' not in uri and not uri.startswith('/') and '..' not in uri.split('?')[0].split('/'):
+                    names.add(prefix + uri)
+        return names
+
+    def fetch(self, name):
+        url = self.cam_url if name == self.playlist_name else self.base_url + name
+        resp = requests.get(url, timeout=(5, 10))
+        resp.raise_for_status()
+        return resp.headers.get('Content-Type', 'application/octet-stream'), resp.content
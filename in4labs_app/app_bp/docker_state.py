@@ -0,0 +1,92 @@
+import threading
+import time
+from datetime import datetime, timezone
+
+import docker
+
+from in4labs_app.metrics import observe_docker_call
+
+
+class ContainerRegistry(object):
+    # Running containers of this host, kept up to date with the Docker events stream
+    # so lookups don't need a round trip to the Docker daemon
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = {} # name -> container info
+        self.client = None
+        self.watcher = None
+
+    def get_client(self):
+        with self.lock:
+            client = self.client
+        if client is None:
+            with observe_docker_call('from_env'):
+                client = docker.from_env()
+            self.sync(client)
+            with self.lock:
+                if self.client is None:
+                    self.client = client
+                    self.watcher = threading.Thread(target=self.watch_events, daemon=True)
+                    self.watcher.start()
+                client = self.client
+        return client
+
+    def sync(self, client):
+        containers = {}
+        for container in client.containers.list():
+            containers[container.name] = {
+                'id': container.id,
+                'image': container.attrs.get('Config', {}).get('Image', ''),
+                'started_at': container.attrs.get('State', {}).get('StartedAt', ''),
+            }
+        with self.lock:
+            self.containers = containers
+
+    def watch_events(self):
+        # Own client, the events stream keeps its connection busy
+        while True:
+            try:
+                client = docker.from_env()
+                # Subscribe before listing, so no event is lost between both calls
+                events = client.events(decode=True, filters={'type': 'container'})
+                self.sync(client)
+                for event in events:
+                    self.handle_event(event)
+            except Exception as e:
+                print(f'Docker events error: {e}')
+            time.sleep(5)
+
+    def handle_event(self, event):
+        action = event.get('Action', '')
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        name = attributes.get('name')
+        if name is None:
+            return
+        with self.lock:
+            if action == 'start':
+                self.containers[name] = {
+                    'id': event.get('id', ''),
+                    'image': attributes.get('image', ''),
+                    'started_at': datetime.fromtimestamp(event.get('time', 0), timezone.utc).isoformat(),
+                }
+            elif action in ('die', 'destroy'):
+                self.containers.pop(name, None)
+
+    def is_running(self, name):
+        with self.lock:
+            return name in self.containers
+
+    def running_names(self):
+        with self.lock:
+            return list(self.containers)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(info) for name, info in self.containers.items()}
+
+
+registry = ContainerRegistry()
+
+def get_docker_client():
+    # Docker client shared by all the threads of the process
+    return registry.get_client()
@@ -0,0 +1,84 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from flask import current_app
+
+import requests
+
+from in4labs_app import cache
+
+
+# Requests to the peers run concurrently, so a slow or offline Raspberry Pi
+# only delays the pages up to FEDERATION_TIMEOUT
+peer_executor = ThreadPoolExecutor(max_workers=8)
+peer_session = requests.Session()
+
+
+def get_peer_url(peer_name, path):
+    # The peers serve the app under their server_name, as this one
+    base_url = current_app.config['FEDERATION_PEERS'][peer_name].rstrip('/')
+    return f'{base_url}/{peer_name}{path}'
+
+def peer_request(peer_name, method, path, timeout, **kwargs):
+    headers = {'X-In4Labs-Token': current_app.config['FEDERATION_TOKEN'] or ''}
+    resp = peer_session.request(method, get_peer_url(peer_name, '/api' + path), headers=headers,
+                                timeout=timeout, **kwargs)
+    return resp.status_code, resp.json()
+
+def get_peer_labs():
+    # Labs of all the peers by peer name, offline peers are left out
+    peers = current_app.config['FEDERATION_PEERS']
+    if not peers:
+        return {}
+    peer_labs = cache.get('federation:labs')
+    if peer_labs is not None:
+        return peer_labs
+
+    timeout = current_app.config['FEDERATION_TIMEOUT']
+    app = current_app._get_current_object()
+    def fetch_labs(peer_name):
+        with app.app_context():
+            status_code, data = peer_request(peer_name, 'GET', '/labs', timeout)
+        if status_code != 200:
+            raise ValueError(data.get('error', status_code))
+        return data['labs']
+
+    futures = {peer_name: peer_executor.submit(fetch_labs, peer_name) for peer_name in peers}
+    wait(futures.values(), timeout=timeout + 1)
+    peer_labs = {}
+    for peer_name, future in futures.items():
+        try:
+            peer_labs[peer_name] = future.result(timeout=0)
+        except Exception as e:
+            print(f'Federation peer {peer_name} not available: {e}')
+    cache.set('federation:labs', peer_labs, timeout=current_app.config['FEDERATION_CACHE_SECONDS'])
+    return peer_labs
+
+def get_peer_lab(peer_name, lab_name):
+    for lab in get_peer_labs().get(peer_name, []):
+        if lab['lab_name'] == lab_name:
+            return lab
+    return None
+
+def get_peer_slots(peer_name, lab_name, start, days, email):
+    # The version changes with each booking done from this server, so the user sees it at once
+    version = cache.get(f'federation:version:{peer_name}:{lab_name}') or 0
+    key = f'federation:slots:{peer_name}:{lab_name}:{version}:{start}:{days}:{email}'
+    slots = cache.get(key)
+    if slots is not None:
+        return 200, slots
+    params = {'start': start, 'days': days, 'email': email}
+    status_code, slots = peer_request(peer_name, 'GET', f'/labs/{lab_name}/slots',
+                                      current_app.config['FEDERATION_TIMEOUT'], params=params)
+    if status_code == 200:
+        cache.set(key, slots, timeout=current_app.config['FEDERATION_CACHE_SECONDS'])
+    return status_code, slots
+
+def book_peer_lab(peer_name, lab_name, email, date_time):
+    # The booking is stored by the peer that owns the Lab
+    data = {'email': email, 'date_time': date_time}
+    status_code, resp = peer_request(peer_name, 'POST', f'/labs/{lab_name}/bookings',
+                                     current_app.config['FEDERATION_TIMEOUT'], json=data)
+    if status_code == 201:
+        cache.set(f'federation:version:{peer_name}:{lab_name}', time.time())
+    return status_code, resp
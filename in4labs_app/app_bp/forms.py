@@ -1,6 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import TimeField, SubmitField, DateField, HiddenField
-from wtforms.validators import DataRequired
+from flask_wtf.file import FileField, FileRequired
+from wtforms import TimeField, SubmitField, DateField, HiddenField, SelectField, SelectMultipleField, \
+    IntegerField, StringField, BooleanField
+from wtforms.validators import DataRequired, NumberRange
 
 
 class BookingForm(FlaskForm):
@@ -16,4 +18,28 @@ class BookingForm(FlaskForm):
 
     def validate_time(self, time):
         round_minute = time.data.minute - (time.data.minute % self.lab_duration)
-        self.time.data = self.time.data.replace(minute=round_minute)
\ No newline at end of file
+        self.time.data = self.time.data.replace(minute=round_minute)
+
+
+weekdays = [('0', 'Monday'), ('1', 'Tuesday'), ('2', 'Wednesday'), ('3', 'Thursday'),
+            ('4', 'Friday'), ('5', 'Saturday'), ('6', 'Sunday')]
+
+class RecurringBookingForm(FlaskForm):
+    # The time slots between start_time and end_time of the weekdays, for some weeks
+    lab_name = SelectField('Lab', validators=[DataRequired()])
+    email = StringField('User email', validators=[DataRequired()])
+    weekdays = SelectMultipleField('Weekdays', choices=weekdays, validators=[DataRequired()])
+    start_date = DateField('First week', validators=[DataRequired()])
+    weeks = IntegerField('Weeks', default=1, validators=[DataRequired(), NumberRange(1, 52)])
+    start_time = TimeField('From', validators=[DataRequired()])
+    end_time = TimeField('To', validators=[DataRequired()])
+    timezone = HiddenField(default='UTC') # filled with the browser timezone
+    check_only = BooleanField('Only check the availability')
+    submit = SubmitField('Reserve')
+
+
+class CsvBookingForm(FlaskForm):
+    # Rows with email,lab_name,date_time (ISO 8601, UTC if there is no offset)
+    file = FileField('CSV file', validators=[FileRequired()])
+    check_only = BooleanField('Only check the availability')
+    submit = SubmitField('Upload')
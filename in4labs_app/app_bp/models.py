@@ -6,4 +6,57 @@ class Booking(db.Model):
     user_id = db.Column(db.Integer, nullable=False)
     mounting_id = db.Column(db.Integer, nullable=False)
     lab_name = db.Column(db.String(20), nullable=False)
-    date_time = db.Column(db.DateTime, nullable=False)
\ No newline at end of file
+    date_time = db.Column(db.DateTime, nullable=False)
+
+    # One booking per mounting and time slot. Also used by the slot lookups
+    # (check_slot, enter_lab, availability grid). The user index is for the reservations page
+    __table_args__ = (
+        db.Index('ux_booking_mounting_date_time', 'mounting_id', 'date_time', unique=True),
+        db.Index('ix_booking_user_date_time', 'user_id', 'date_time'),
+    )
+
+
+class BookingArchive(db.Model):
+    # Bookings of past time slots, moved out of the booking table by the LabScheduler.
+    # Own id, SQLite can reuse the ids of deleted bookings
+    id = db.Column(db.Integer, primary_key=True, nullable=False, unique=True)
+    booking_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)
+    mounting_id = db.Column(db.Integer, nullable=False)
+    lab_name = db.Column(db.String(20), nullable=False)
+    date_time = db.Column(db.DateTime, nullable=False)
+    entered = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.Index('ix_booking_archive_user_date_time', 'user_id', 'date_time'),
+    )
+
+
+class UsageRollup(db.Model):
+    # Usage of the labs per hour and per day (UTC), added by the LabScheduler once the time
+    # slots end. Sums and counts, so the averages of any range are computed from them
+    period = db.Column(db.String(4), primary_key=True) # 'hour' or 'day'
+    start = db.Column(db.DateTime, primary_key=True)
+    lab_name = db.Column(db.String(20), primary_key=True)
+    mounting_id = db.Column(db.Integer, primary_key=True)
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    entered = db.Column(db.Integer, nullable=False, default=0)
+    starts = db.Column(db.Integer, nullable=False, default=0) # sessions with the Lab ready
+    start_seconds = db.Column(db.Float, nullable=False, default=0)
+    sessions = db.Column(db.Integer, nullable=False, default=0) # entered sessions already stopped
+    session_seconds = db.Column(db.Float, nullable=False, default=0)
+
+
+class LabSession(db.Model):
+    # Containers of a booking: starting -> ready -> entered -> stopped
+    id = db.Column(db.Integer, primary_key=True, nullable=False, unique=True)
+    booking_id = db.Column(db.Integer, nullable=False, unique=True)
+    mounting_id = db.Column(db.Integer, nullable=False)
+    lab_name = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='starting')
+    start_time = db.Column(db.DateTime, nullable=False)
+    end_time = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime) # containers launched
+    ready_at = db.Column(db.DateTime)
+    entered_at = db.Column(db.DateTime)
+    stopped_at = db.Column(db.DateTime)
@@ -0,0 +1,159 @@
+import select
+import socket
+import time
+from urllib.parse import quote, urlsplit
+
+from flask import current_app, request, Response
+
+import requests
+
+
+# Connections to the Lab containers are reused by all the threads of the worker
+upstream_session = requests.Session()
+upstream_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
+hop_by_hop_headers = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te',
+                      'trailers', 'transfer-encoding', 'upgrade', 'host', 'content-length'}
+chunk_size = 64 * 1024
+proxy_methods = ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+
+
+class RequestBody(object):
+    # Request body with its length, so it is streamed with a Content-Length header
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.len = length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+class HijackedResponse(Response):
+    # The connection was taken over by the WebSocket tunnel, end the request without
+    # writing a response: Gunicorn closes the connection on StopIteration, and the Flask
+    # development server on ConnectionError
+    def __call__(self, environ, start_response):
+        if 'gunicorn.socket' in environ:
+            raise StopIteration()
+        raise ConnectionError('WebSocket closed')
+
+def iter_request_body():
+    # Request body without length (chunked), streamed as it is received
+    while True:
+        chunk = request.stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def get_upstream_uri():
+    # The path and query as the browser sent them, request.full_path is decoded and %2F, %3F,
+    # %23 or %20 would change their meaning (or break the request line of the WebSocket)
+    uri = request.environ.get('RAW_URI') or request.environ.get('REQUEST_URI')
+    if not uri:
+        uri = quote(request.path) + ('?' + request.query_string.decode('latin-1') if request.query_string else '')
+    if not uri.startswith('/'): # absolute form (http://host/path)
+        uri = urlsplit(uri)._replace(scheme='', netloc='').geturl() or '/'
+    # Only URI characters, anything else (spaces, CR/LF, non-ASCII) is percent-encoded
+    return quote(uri.encode('latin-1'), safe="/:@!$&'()*+,;=?%~")
+
+def get_upstream_headers():
+    # Request headers for the Lab container, without the In4Labs session cookies
+    headers = {name: value for name, value in request.headers.items()
+               if name.lower() not in hop_by_hop_headers and name.lower() != 'cookie'}
+    app_cookies = (current_app.config['SESSION_COOKIE_NAME'],
+                   current_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+    cookies = [f'{name}={value}' for name, value in request.cookies.items() if name not in app_cookies]
+    if cookies:
+        headers['Cookie'] = '; '.join(cookies)
+    headers['X-Forwarded-For'] = request.remote_addr or ''
+    headers['X-Forwarded-Host'] = request.host
+    headers['X-Forwarded-Proto'] = request.scheme
+    return headers
+
+def proxy_request(host_port):
+    # Stream the request body to the Lab container and its response back, without buffering
+    upstream_url = f'http://127.0.0.1:{host_port}'
+    if request.content_length:
+        body = RequestBody(request.stream, request.content_length)
+    elif request.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        body = iter_request_body()
+    else:
+        body = None
+    try:
+        upstream = upstream_session.request(
+            request.method, upstream_url + get_upstream_uri(), headers=get_upstream_headers(),
+            data=body, stream=True, allow_redirects=False, timeout=(5, 60))
+    except requests.RequestException as e:
+        print(f'Lab proxy error: {e}')
+        return Response('The Lab is not available.', status=502)
+
+    headers = []
+    for name, value in upstream.raw.headers.items():
+        if name.lower() in hop_by_hop_headers and name.lower() != 'content-length':
+            continue
+        if name.lower() == 'location' and value.startswith(upstream_url): # redirect to itself
+            value = value[len(upstream_url):] or '/'
+        headers.append((name, value))
+    response = Response(upstream.raw.stream(chunk_size, decode_content=False), status=upstream.status_code,
+                        headers=headers, direct_passthrough=True)
+    response.call_on_close(upstream.close)
+    return response
+
+def get_client_socket():
+    # Raw connection of the browser, in Gunicorn and the Flask development server
+    return request.environ.get('gunicorn.socket') or request.environ.get('werkzeug.socket')
+
+def proxy_websocket(host_port, end_dt):
+    # Send the WebSocket handshake to the Lab container and, once accepted, tunnel the raw
+    # connections of both sides until one of them closes or the time slot ends
+    client_sock = get_client_socket()
+    if client_sock is None:
+        return Response('WebSockets are not supported by this server.', status=501)
+    try:
+        upstream_sock = socket.create_connection(('127.0.0.1', host_port), timeout=5)
+    except OSError as e:
+        print(f'Lab proxy WebSocket error: {e}')
+        return Response('The Lab is not available.', status=502)
+    hijacked = False
+    try:
+        headers = get_upstream_headers()
+        headers.update({'Host': f'127.0.0.1:{host_port}', 'Connection': 'Upgrade', 'Upgrade': 'websocket'})
+        handshake = f'GET {get_upstream_uri()} HTTP/1.1\r\n' + \
+            ''.join(f'{name}: {value}\r\n' for name, value in headers.items()) + '\r\n'
+        upstream_sock.sendall(handshake.encode('latin-1'))
+        data = b''
+        while b'\r\n\r\n' not in data:
+            chunk = upstream_sock.recv(chunk_size)
+            if not chunk:
+                raise OSError('connection closed during the handshake')
+            data += chunk
+        status_code = int(data.split(b' ', 2)[1])
+        if status_code != 101:
+            return Response('The Lab rejected the WebSocket.', status=status_code)
+
+        # The response of the Lab (and its first frames) goes to the browser as it is, the
+        # server can't send anything else on this connection
+        upstream_sock.settimeout(None)
+        hijacked = True
+        client_sock.sendall(data)
+        pipe_sockets(client_sock, upstream_sock, end_dt.timestamp())
+        client_sock.shutdown(socket.SHUT_RDWR)
+    except (OSError, ValueError, IndexError) as e:
+        print(f'Lab proxy WebSocket error: {e}')
+        if not hijacked:
+            return Response('The Lab is not available.', status=502)
+    finally:
+        upstream_sock.close()
+    return HijackedResponse()
+
+def pipe_sockets(client_sock, upstream_sock, deadline):
+    peers = {client_sock: upstream_sock, upstream_sock: client_sock}
+    while time.time() < deadline:
+        readable, _, _ = select.select(list(peers), [], [], 1)
+        for sock in readable:
+            try:
+                data = sock.recv(chunk_size)
+                if not data:
+                    return
+                peers[sock].sendall(data)
+            except OSError:
+                return
@@ -1,37 +1,64 @@
-import os
-import time
-import requests
+import csv
+import hashlib
+import io
 from datetime import datetime, timedelta, timezone
 
-from flask import current_app, render_template, redirect, url_for, flash, request, jsonify
+from flask import current_app, render_template, redirect, url_for, flash, request, jsonify, Response, session, \
+    abort
 from flask_login import current_user, login_required
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from sqlalchemy import and_, or_
+from wtforms.validators import ValidationError
+import requests
 
-import docker
-
-from in4labs_app import db, server_name, mountings, labs
+from in4labs_app import db, cache, server_name, get_registry
 from in4labs_app.app_bp import bp
-from .models import Booking
-from .forms import BookingForm
-from .utils import StopContainersTask, setup_node_red, get_lab
+from in4labs_app.auth.models import User
+from in4labs_app.database import insert_or_ignore
+from in4labs_app.metrics import render_metrics, enter_to_ready_seconds
+from .models import Booking, LabSession, UsageRollup
+from .forms import BookingForm, RecurringBookingForm, CsvBookingForm
+from .utils import get_lab, set_session_status, admin_required, peer_required, get_slots_version, \
+    bump_slots_version
+from .scheduler import ACTIVE_STATUS, claim_lab_session, launch_lab_session
+from .docker_state import registry
+from . import analytics, bulk, cam_relay, federation, proxy
 
 
 @bp.route('/')
 @login_required
 def index():
-    if len(labs) == 1:
+    labs = get_registry().lab_list
+    peer_labs = federation.get_peer_labs()
+    if len(labs) == 1 and not any(peer_labs.values()):
         return redirect(url_for('app.book_lab', lab_name=labs[0]['lab_name']))
-    else:
-        return render_template('select_lab.html', labs=labs, user_email=current_user.email)
+
+    # The page only changes with the labs configuration (or the peers), unless there are messages
+    etag = hashlib.sha1(repr((get_registry().version, peer_labs, current_user.email)).encode()).hexdigest()
+    if not session.get('_flashes') and request.if_none_match.contains(etag):
+        return not_modified(etag)
+    response = current_app.make_response(render_template(
+        'select_lab.html', labs=labs, peer_labs=peer_labs, user_email=current_user.email))
+    return set_revalidate(response, etag)
+
+def not_modified(etag):
+    return set_revalidate(Response(status=304), etag)
+
+def set_revalidate(response, etag):
+    # The browser keeps the response, but asks with If-None-Match before using it
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 @bp.route('/book/<lab_name>/', methods=['GET', 'POST'])
 @login_required
 def book_lab(lab_name):
-    lab = get_lab(labs, lab_name)
-    # get mounting & duration
-    mounting = next((m for m in mountings if m['id'] == lab['mounting_id']), None)
-    if mounting is None:
-        flash('Invalid lab configuration.', 'error')
+    lab = get_lab(lab_name)
+    if lab is None:
+        flash('Lab not found.', 'error')
         return redirect(url_for('app.index'))
+    mounting = lab['mounting']
     lab_duration = mounting['duration']
 
     form = BookingForm(lab_duration)
@@ -39,29 +66,24 @@ def book_lab(lab_name):
         user_datetime = datetime.fromisoformat(form.date_time.data)
         formatted_user_datetime = user_datetime.strftime('%d/%m/%Y @ %H:%Mh')
         utc_user_datetime = user_datetime.astimezone(timezone.utc)
-        # check slot again
-        booking = Booking.query.filter_by(
-            mounting_id=lab['mounting_id'],
-            date_time=utc_user_datetime
-        ).first()
-        if booking:
+        # the unique index rejects the slot if someone else just booked it
+        inserted = insert_or_ignore(Booking, {
+            'user_id': current_user.id,
+            'mounting_id': lab['mounting_id'],
+            'lab_name': lab['lab_name'],
+            'date_time': utc_user_datetime,
+        })
+        if not inserted:
             flash('Someone else just booked that slot, please select a different one.', 'error')
             return redirect(url_for('app.book_lab', lab_name=lab_name))
-
-        booking = Booking(
-            user_id=current_user.id,
-            mounting_id=lab['mounting_id'],
-            lab_name=lab['lab_name'],
-            date_time=utc_user_datetime
-        )
-        db.session.add(booking)
-        db.session.commit()
+        bump_slots_version(lab['mounting_id'])
         flash(f'{lab["html_name"]} reserved successfully for {formatted_user_datetime}', 'success')
         return redirect(url_for('app.book_lab', lab_name=lab_name))
 
     tpl_kwargs = {
         'lab': lab,
         'lab_duration': lab_duration,
+        'enter_url': url_for('app.enter_lab', lab_name=lab_name),
         'user_email': current_user.email,
         'form': form,
     }
@@ -71,10 +93,10 @@ def book_lab(lab_name):
 @bp.route('/book/<lab_name>/check_slot')
 @login_required
 def check_slot(lab_name):
-    lab = get_lab(labs, lab_name)
-    mounting = next((m for m in mountings if m['id'] == lab['mounting_id']), None)
-    if mounting is None:
-        return jsonify('Invalid lab configuration.')
+    lab = get_lab(lab_name)
+    if lab is None:
+        return jsonify('Lab not found.')
+    mounting = lab['mounting']
     lab_duration = mounting['duration']
     mounting_id = lab['mounting_id']
 
@@ -87,33 +109,98 @@ def check_slot(lab_name):
     round_minute = actual.minute - (actual.minute % lab_duration)
     round_dt = actual.replace(minute=round_minute, second=0, microsecond=0)
     if utc_user_datetime < round_dt:
-        return jsonify(
-            f'The date/time ({formatted_user_datetime}) is outdate, please select a different one.'
-        )
+        return jsonify(get_slot_message('past', formatted_user_datetime))
 
     booking = Booking.query.filter_by(
         mounting_id=mounting_id,
         date_time=utc_user_datetime
     ).first()
-    if booking:
-        resp = f'''Time slot for {formatted_user_datetime} is already 
+    state = 'booked' if booking else 'free'
+    return jsonify(get_slot_message(state, formatted_user_datetime))
+
+def parse_slots_range():
+    # start is the local midnight of the first day, with the user timezone offset
+    try:
+        start_dt = datetime.fromisoformat(request.args.get('start', ''))
+        days = int(request.args.get('days', 1))
+    except ValueError:
+        return None, None
+    if start_dt.tzinfo is None or days not in (1, 7):
+        return None, None
+    return start_dt, days
+
+def get_slot_states(lab, start_dt, days, user_id):
+    # Availability of all the timeslots of a day or a week with a single query
+    lab_duration = lab['mounting']['duration']
+    end_dt = start_dt + timedelta(days=days)
+    utc_start_dt = start_dt.astimezone(timezone.utc)
+    utc_end_dt = end_dt.astimezone(timezone.utc)
+
+    # booked slots in the range (date_time is stored as naive UTC), cached until the next booking
+    version = get_slots_version(lab['mounting_id'])
+    key = f'booked:{lab["mounting_id"]}:{version}:{utc_start_dt.isoformat()}:{days}'
+    booked = cache.get(key)
+    if booked is None:
+        bookings = Booking.query.with_entities(Booking.date_time, Booking.user_id).filter(
+            Booking.mounting_id == lab['mounting_id'],
+            Booking.date_time >= utc_start_dt,
+            Booking.date_time < utc_end_dt
+        ).all()
+        booked = {b.date_time: b.user_id for b in bookings}
+        cache.set(key, booked)
+
+    actual = datetime.now(timezone.utc)
+    round_minute = actual.minute - (actual.minute % lab_duration)
+    round_dt = actual.replace(minute=round_minute, second=0, microsecond=0)
+
+    slots = []
+    slot_dt = start_dt
+    while slot_dt < end_dt:
+        utc_slot_dt = slot_dt.astimezone(timezone.utc)
+        booking_user_id = booked.get(utc_slot_dt.replace(tzinfo=None))
+        if booking_user_id is not None:
+            state = 'mine' if booking_user_id == user_id else 'booked'
+        elif utc_slot_dt < round_dt:
+            state = 'past'
+        else:
+            state = 'free'
+        slots.append({'date_time': slot_dt.isoformat(), 'state': state})
+        slot_dt += timedelta(minutes=lab_duration)
+    return {'duration': lab_duration, 'slots': slots}
+
+def get_slot_message(state, formatted_user_datetime):
+    if state == 'past':
+        return f'The date/time ({formatted_user_datetime}) is outdate, please select a different one.'
+    if state in ('booked', 'mine'):
+        return f'''Time slot for {formatted_user_datetime} is already 
                        reserved, please select a different one.'''
-    else:
-        resp = f'''Time slot for {formatted_user_datetime} is available.
+    return f'''Time slot for {formatted_user_datetime} is available.
                         Do you want to reserve the Lab? '''
-         
-    return jsonify(resp)
 
-@bp.route('/enter/<lab_name>/', methods=['GET'])
+# Get the availability of all the timeslots of a day or a week with a single query
+@bp.route('/book/<lab_name>/slots')
 @login_required
-def enter_lab(lab_name):
-    lab = get_lab(labs, lab_name)
-    mounting = next((m for m in mountings if m['id'] == lab['mounting_id']), None)
-    if mounting is None:
-        flash('Invalid lab configuration.', 'error')
-        return redirect(url_for('app.index'))
-    lab_duration = mounting['duration']
+def get_slots(lab_name):
+    lab = get_lab(lab_name)
+    if lab is None:
+        return jsonify({'error': 'Lab not found.'}), 404
+    start_dt, days = parse_slots_range()
+    if start_dt is None:
+        return jsonify({'error': 'Invalid start date or number of days.'}), 400
 
+    # Repeated polls get a 304 until a booking changes the mounting or a time slot ends
+    now = datetime.now(timezone.utc)
+    lab_duration = lab['mounting']['duration']
+    round_dt = now.replace(minute=now.minute - now.minute % lab_duration, second=0, microsecond=0)
+    etag = hashlib.sha1(repr((get_slots_version(lab['mounting_id']), lab_name, start_dt, days,
+                              current_user.id, round_dt)).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    response = jsonify(get_slot_states(lab, start_dt, days, current_user.id))
+    return set_revalidate(response, etag)
+
+def get_current_booking(lab, mounting):
+    lab_duration = mounting['duration']
     now = datetime.now(timezone.utc)
     start_minute = now.minute - (now.minute % lab_duration)
     start_dt = now.replace(minute=start_minute, second=0, microsecond=0)
@@ -124,96 +211,445 @@ def enter_lab(lab_name):
         date_time=start_dt
     ).first()
     if not booking or booking.user_id != current_user.id:
-        flash("You don't have a reservation in this Lab for the current time slot.", 'error')
-        return redirect(url_for('app.book_lab', lab_name=lab_name))
+        return None
+    return booking
 
+def get_lab_url(lab_name, host_port):
     lab_url = f'/{server_name}/{lab_name}/'
-    host_port = mounting['host_port']
-    if current_app.config['ENV'] != 'production': # don't use reverse proxy
+    # without a reverse proxy (external or LAB_PROXY), go to the container port
+    if current_app.config['ENV'] != 'production' and not current_app.config['LAB_PROXY']:
         hostname = request.headers.get('Host').split(':')[0]
         lab_url = f'http://{hostname}:{host_port}/{server_name}/{lab_name}/'
-    
-    client = docker.from_env()
-    # Create a unique container name with the lab name and the start date time
-    container_name = f'{lab_name.lower()}-{start_dt.strftime("%Y%m%d%H%M")}'
+    return lab_url
 
-    # Check if the actual time slot container is already running (e.g. the user click twice on the Enter button).
-    # If so, redirect to the container url. If not, start the container
-    try:
-        container = client.containers.get(container_name)
-        return redirect(lab_url)
-    except docker.errors.NotFound:
-        pass 
-    
-    # NOTE: The thread created by the StopContainersTask class sometimes doesn't stop the lab container,
-    # so check if there is any previous container running and stop it  
+@bp.route('/enter/<lab_name>/', methods=['GET'])
+@login_required
+def enter_lab(lab_name):
+    lab = get_lab(lab_name)
+    if lab is None:
+        flash('Lab not found.', 'error')
+        return redirect(url_for('app.index'))
+    mounting = lab['mounting']
+
+    booking = get_current_booking(lab, mounting)
+    if booking is None:
+        flash("You don't have a reservation in this Lab for the current time slot.", 'error')
+        return redirect(url_for('app.book_lab', lab_name=lab_name))
+
+    # The containers are usually prewarmed by the scheduler before the time slot starts.
+    # If not (e.g. late booking or nobody entered in time), start them in the background
+    lab_session = LabSession.query.filter_by(booking_id=booking.id).first()
+    if lab_session is None:
+        lab_session = claim_lab_session(booking, lab, mounting)
+        start = lab_session is not None
+        if not start: # claimed by the scheduler in the meantime
+            lab_session = LabSession.query.filter_by(booking_id=booking.id).first()
+    else:
+        start = set_session_status(lab_session.id, 'starting', ('stopped',), ready_at=None,
+                                   started_at=datetime.now(timezone.utc), stopped_at=None)
+
+    if start:
+        launch_lab_session(current_app._get_current_object(), lab_session.id, lab, mounting,
+                           current_user.email, current_app.config['LAB_READY_TIMEOUT'])
+
+    first_enter = lab_session.entered_at is None
+    set_session_status(lab_session.id, 'entered', ('starting', 'ready', 'entered'),
+                       entered_at=datetime.now(timezone.utc))
+    if lab_session.ready_at is not None:
+        if first_enter: # prewarmed, no wait
+            enter_to_ready_seconds.observe(0)
+        return redirect(get_lab_url(lab_name, mounting['host_port']))
+
+    # Don't wait for the containers here, the page polls lab_status until the Lab is ready
+    tpl_kwargs = {
+        'lab': lab,
+        'user_email': current_user.email,
+    }
+    return render_template('lab_starting.html', **tpl_kwargs)
+
+# Check if the Lab containers are ready with AJAX
+@bp.route('/enter/<lab_name>/status')
+@login_required
+def lab_status(lab_name):
+    lab = get_lab(lab_name)
+    if lab is None:
+        return jsonify({'status': 'error', 'message': 'Lab not found.'})
+    mounting = lab['mounting']
+
+    booking = get_current_booking(lab, mounting)
+    lab_session = LabSession.query.filter_by(booking_id=booking.id).first() if booking else None
+    if lab_session is None or lab_session.status == 'stopped':
+        return jsonify({'status': 'error', 'message': 'The Lab could not be started, please try again.'})
+    if lab_session.ready_at is None:
+        return jsonify({'status': 'starting'})
+    return jsonify({'status': 'ready', 'lab_url': get_lab_url(lab_name, mounting['host_port'])})
+
+# Reverse proxy to the Lab container, for the user with the booking of the current time slot
+@bp.route('/<lab_name>/', defaults={'path': ''}, methods=proxy.proxy_methods)
+@bp.route('/<lab_name>/<path:path>', methods=proxy.proxy_methods)
+@bp.route('/<lab_name>/', defaults={'path': ''}, websocket=True)
+@bp.route('/<lab_name>/<path:path>', websocket=True)
+@login_required
+def lab_proxy(lab_name, path):
+    lab = get_lab(lab_name)
+    if lab is None or not current_app.config['LAB_PROXY']:
+        abort(404)
+    mounting = lab['mounting']
+    end_dt = get_booking_end(lab, mounting)
+    if end_dt is None:
+        abort(403)
+    if request.headers.get('Upgrade', '').lower() == 'websocket':
+        return proxy.proxy_websocket(mounting['host_port'], end_dt)
+    return proxy.proxy_request(mounting['host_port'])
+
+def get_booking_end(lab, mounting):
+    # End of the time slot if the user has its booking, cached so the requests of
+    # the Lab page don't query the db. A booking of the current slot can't be cancelled
+    now = datetime.now(timezone.utc)
+    start_dt = now.replace(minute=now.minute - now.minute % mounting['duration'], second=0, microsecond=0)
+    end_dt = start_dt + timedelta(minutes=mounting['duration'])
+    key = f'proxy:{current_user.id}:{lab["lab_name"]}:{start_dt.isoformat()}'
+    if cache.get(key):
+        return end_dt
+    if get_current_booking(lab, mounting) is None:
+        return None
+    cache.set(key, True, timeout=int((end_dt - now).total_seconds()) + 1)
+    return end_dt
+
+# Webcam of a mounting, read once and sent to the users with a booking in its Labs and the admins
+@bp.route('/cam/<mounting_id>/', defaults={'path': ''})
+@bp.route('/cam/<mounting_id>/<path:path>')
+@login_required
+def cam(mounting_id, path):
+    mounting = get_registry().mountings.get(mounting_id)
+    mounting_labs = get_registry().mounting_labs.get(mounting_id, ())
+    if mounting is None or not mounting_labs or not current_app.config['CAM_RELAY']:
+        abort(404)
+    if current_user.email in current_app.config['ADMIN_EMAILS']:
+        end_dt = datetime.now(timezone.utc) + timedelta(hours=1)
+    else:
+        end_dts = [get_booking_end(lab, mounting) for lab in mounting_labs]
+        end_dt = next((end_dt for end_dt in end_dts if end_dt is not None), None)
+        if end_dt is None:
+            abort(403)
+
+    relay = cam_relay.get_relay(mounting, current_app.config['CAM_RELAY_RING_SIZE'])
+    if isinstance(relay, cam_relay.HlsRelay):
+        # The segments are matched with their query strings, as listed in the playlists
+        name = f'{path}?{request.query_string.decode()}' if path and request.query_string else path
+        try:
+            hls_file = relay.get_file(name)
+        except requests.RequestException as e:
+            print(f'Webcam {mounting["cam_url"]} not available: {e}')
+            abort(502)
+        if hls_file is None:
+            abort(404)
+        content_type, content = hls_file
+        headers = {'Cache-Control': 'no-cache'} if content_type == 'application/vnd.apple.mpegurl' else {}
+        return Response(content, content_type=content_type, headers=headers)
+    # A MJPEG viewer keeps a thread until it leaves, without threads it would block the worker
+    if not request.environ.get('wsgi.multithread'):
+        return Response('The webcam relay needs threaded workers (--threads).', status=503)
+    return Response(relay.iter_frames(end_dt.timestamp()), mimetype=relay.mimetype,
+                    headers={'Cache-Control': 'no-cache'})
+
+@bp.route('/admin/containers')
+@admin_required
+def admin_containers():
+    sessions = LabSession.query.filter(
+        LabSession.status.in_(ACTIVE_STATUS)
+    ).order_by(LabSession.start_time).all()
+    tpl_kwargs = {
+        'containers': registry.snapshot(),
+        'sessions': sessions,
+        'user_email': current_user.email,
+    }
+    return render_template('admin_containers.html', **tpl_kwargs)
+
+# Bulk reservations for the practical sessions of a class: a recurring rule or a CSV file,
+# checked with one query and booked in one transaction. ?format=json returns the results as JSON
+@bp.route('/admin/bookings', methods=['GET', 'POST'])
+@admin_required
+def admin_bookings():
+    rule_form = RecurringBookingForm(prefix='rule')
+    rule_form.lab_name.choices = [(lab['lab_name'], lab['html_name']) for lab in get_registry().lab_list]
+    csv_form = CsvBookingForm(prefix='csv')
+    rows = None
+    check_only = False
+    if rule_form.submit.data and rule_form.validate_on_submit():
+        if rule_form.end_time.data <= rule_form.start_time.data:
+            flash('The end time must be after the start time.', 'error')
+        else:
+            rows = bulk.expand_rule(rule_form.lab_name.data, rule_form.email.data.strip(),
+                                    [int(weekday) for weekday in rule_form.weekdays.data],
+                                    rule_form.start_date.data, rule_form.weeks.data,
+                                    rule_form.start_time.data, rule_form.end_time.data,
+                                    rule_form.timezone.data)
+            check_only = rule_form.check_only.data
+    elif csv_form.submit.data and csv_form.validate_on_submit():
+        rows = bulk.read_csv(csv_form.file.data.stream)
+        check_only = csv_form.check_only.data
+    results = bulk.book_rows(rows, check_only) if rows is not None else None
+
+    if request.args.get('format') == 'json':
+        if results is None:
+            return jsonify({'errors': dict(rule_form.errors, **csv_form.errors)}), 400
+        return jsonify({'results': results})
+    tpl_kwargs = {
+        'rule_form': rule_form,
+        'csv_form': csv_form,
+        'results': results,
+        'check_only': check_only,
+        'user_email': current_user.email,
+    }
+    return render_template('admin_bookings.html', **tpl_kwargs)
+
+# Usage of the labs from the rollups, per day or hour. ?format=csv or json to export it
+@bp.route('/admin/usage')
+@admin_required
+def admin_usage():
+    period = request.args.get('period', 'day')
+    if period not in ('day', 'hour'):
+        period = 'day'
+    days = min(max(request.args.get('days', 30, type=int), 1), 366)
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    usages = UsageRollup.query.filter(
+        UsageRollup.period == period,
+        UsageRollup.start >= today - timedelta(days=days - 1)
+    ).order_by(UsageRollup.start.desc(), UsageRollup.lab_name).all()
+    rows = [analytics.get_usage_row(usage) for usage in usages]
+
+    export_format = request.args.get('format')
+    if export_format == 'json':
+        return jsonify({'period': period, 'days': days, 'rows': rows})
+    if export_format == 'csv':
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=analytics.usage_fields)
+        writer.writeheader()
+        writer.writerows(rows)
+        return Response(output.getvalue(), mimetype='text/csv', headers={
+            'Content-Disposition': f'attachment; filename=in4labs_usage_{period}.csv'})
+    tpl_kwargs = {
+        'period': period,
+        'days': days,
+        'rows': rows,
+        'totals': analytics.get_usage_totals(usages),
+        'user_email': current_user.email,
+    }
+    return render_template('admin_usage.html', **tpl_kwargs)
+
+# Upcoming reservations of the user, paginated by (date_time, id) with the user index
+@bp.route('/reservations/')
+@login_required
+def reservations():
+    page_size = 20
+    # Time slots last 60 minutes at most, the ones that already ended are left out below
+    now = datetime.now(timezone.utc)
+    query = Booking.query.filter(
+        Booking.user_id == current_user.id,
+        Booking.date_time >= now - timedelta(minutes=60)
+    )
     try:
-        containers = client.containers.list()
-        for container in containers:
-            if container.name.startswith(lab_name.lower()):
-                container.stop()
-    except docker.errors.NotFound:
+        after_dt = datetime.fromisoformat(request.args['after_time'])
+        after_id = int(request.args['after_id'])
+        query = query.filter(or_(
+            Booking.date_time > after_dt,
+            and_(Booking.date_time == after_dt, Booking.id > after_id)
+        ))
+    except (KeyError, ValueError):
         pass
+    bookings = query.order_by(Booking.date_time, Booking.id).limit(page_size + 1).all()
+    next_page = None
+    if len(bookings) > page_size:
+        bookings = bookings[:page_size]
+        last = bookings[-1]
+        next_page = url_for('app.reservations', after_time=last.date_time.isoformat(), after_id=last.id)
 
-    containers = []
-    # Check if the lab needs extra containers and run them
-    extra_containers = lab.get('extra_containers', [])
-    for extra_container in extra_containers:
-        if extra_container['name'] == 'node-red':
-            volume_name = list(extra_container['volumes'].keys())[0]
-            basedir = os.path.abspath(os.path.dirname(__file__))
-            nodered_dir = os.path.join(basedir, 'labs', lab_name, 'node-red')
-            setup_node_red(client, volume_name, nodered_dir, current_user.email)
-
-        container_extra = client.containers.run(
-                        extra_container['image'], 
-                        name=extra_container["name"],
-                        detach=True,
-                        remove=True,
-                        ports=extra_container['ports'],
-                        volumes=extra_container.get('volumes', {}),
-                        network=extra_container.get('network', ''),
-                        command=extra_container.get('command', ''))
-        containers.append(container_extra)
-    
-    # Run the lab container        
-    lab_image_name = f'{lab_name.lower()}:latest'
-    lab_volumes = {'/dev/bus/usb': {'bind': '/dev/bus/usb', 'mode': 'rw'}}
-    lab_volumes.update(lab.get('volumes', {}))
-    end_time = start_dt + timedelta(minutes=lab_duration)
-    docker_env = {
-        'SERVER_NAME': server_name,
-        'LAB_NAME': lab_name,
-        'USER_EMAIL': current_user.email,
-        'END_TIME': end_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-        'CAM_URL': mounting['cam_url'],
+    registry_labs = get_registry().labs
+    rows = []
+    for booking in bookings:
+        lab = registry_labs.get(booking.lab_name)
+        lab_duration = lab['mounting']['duration'] if lab else 60
+        start_dt = booking.date_time.replace(tzinfo=timezone.utc)
+        if start_dt + timedelta(minutes=lab_duration) <= now:
+            continue
+        rows.append({
+            'id': booking.id,
+            'lab_name': booking.lab_name,
+            'html_name': lab['html_name'] if lab else booking.lab_name,
+            'date_time': start_dt.isoformat(),
+            'started': start_dt <= now,
+        })
+
+    tpl_kwargs = {
+        'bookings': rows,
+        'next_page': next_page,
+        'csrf_token': generate_csrf(),
+        'user_email': current_user.email,
     }
+    return render_template('reservations.html', **tpl_kwargs)
 
-    container_lab = client.containers.run(
-                    lab_image_name, 
-                    name=container_name,
-                    detach=True, 
-                    remove=True,
-                    privileged=True,
-                    #devices=['/dev/ttyACM[0-9]*:/dev/ttyACM[0-9]*:rwm'],
-                    volumes=lab_volumes,
-                    ports={'8000/tcp': ('0.0.0.0', host_port)}, 
-                    environment=docker_env)
-    containers.append(container_lab)
-
-    stop_containers = StopContainersTask(lab_name, containers, end_time, current_user.email)
-    stop_containers.start()
-
-    # wait up to 10s for the container’s web server to respond
-    start_time = time.time()
-    timeout = 10
-    while time.time() - start_time < timeout:
+# Cancel a reservation with AJAX, before its time slot starts and its Lab is prewarmed
+@bp.route('/reservations/<int:booking_id>/cancel', methods=['POST'])
+@login_required
+def cancel_reservation(booking_id):
+    try:
+        validate_csrf(request.headers.get('X-CSRFToken'))
+    except ValidationError:
+        return jsonify({'error': 'Invalid CSRF token.'}), 400
+    mounting_id = db.session.query(Booking.mounting_id).filter_by(
+        id=booking_id, user_id=current_user.id).scalar()
+    if mounting_id is None:
+        return jsonify({'error': 'Reservation not found.'}), 404
+    # A single statement, so the scheduler can't prewarm the Lab in the meantime
+    now = datetime.now(timezone.utc)
+    session_exists = LabSession.query.filter(LabSession.booking_id == Booking.id).exists()
+    deleted = Booking.query.filter(
+        Booking.id == booking_id,
+        Booking.user_id == current_user.id,
+        Booking.date_time > now,
+        ~session_exists
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if deleted:
+        bump_slots_version(mounting_id)
+        return jsonify({'status': 'cancelled'})
+    if not Booking.query.filter_by(id=booking_id).count():
+        return jsonify({'error': 'Reservation not found.'}), 404
+    return jsonify({'error': 'The Lab of this reservation is already starting.'}), 409
+
+# API of the federation peers, the bookings are done for the user with the same email
+@bp.route('/api/labs')
+@peer_required
+def api_labs():
+    labs = [{
+        'lab_name': lab['lab_name'],
+        'html_name': lab['html_name'],
+        'description': lab['description'],
+        'duration': lab['mounting']['duration'],
+    } for lab in get_registry().lab_list]
+    return jsonify({'server_name': server_name, 'labs': labs})
+
+@bp.route('/api/labs/<lab_name>/slots')
+@peer_required
+def api_slots(lab_name):
+    lab = get_lab(lab_name)
+    if lab is None:
+        return jsonify({'error': 'Lab not found.'}), 404
+    start_dt, days = parse_slots_range()
+    if start_dt is None:
+        return jsonify({'error': 'Invalid start date or number of days.'}), 400
+    user = User.query.filter_by(email=request.args.get('email', '')).first()
+    return jsonify(get_slot_states(lab, start_dt, days, user.id if user else None))
+
+@bp.route('/api/labs/<lab_name>/bookings', methods=['POST'])
+@peer_required
+def api_book_lab(lab_name):
+    lab = get_lab(lab_name)
+    if lab is None:
+        return jsonify({'error': 'Lab not found.'}), 404
+    data = request.get_json(silent=True) or {}
+    user = User.query.filter_by(email=data.get('email', '')).first()
+    if user is None:
+        return jsonify({'error': f'The user is not registered in {server_name}.'}), 404
+    try:
+        utc_user_datetime = datetime.fromisoformat(data.get('date_time', '')).astimezone(timezone.utc)
+    except ValueError:
+        return jsonify({'error': 'Invalid date/time.'}), 400
+    lab_duration = lab['mounting']['duration']
+    if utc_user_datetime.minute % lab_duration or utc_user_datetime < datetime.now(timezone.utc) - timedelta(minutes=lab_duration):
+        return jsonify({'error': 'Invalid date/time.'}), 400
+    inserted = insert_or_ignore(Booking, {
+        'user_id': user.id,
+        'mounting_id': lab['mounting_id'],
+        'lab_name': lab['lab_name'],
+        'date_time': utc_user_datetime.replace(second=0, microsecond=0),
+    })
+    if not inserted:
+        return jsonify({'error': 'Someone else just booked that slot.'}), 409
+    bump_slots_version(lab['mounting_id'])
+    return jsonify({'status': 'booked'}), 201
+
+# Labs of the federation peers, shown and booked from this server
+def get_remote_lab(peer_name, lab_name):
+    peer_lab = federation.get_peer_lab(peer_name, lab_name)
+    if peer_lab is None:
+        return None
+    return dict(peer_lab, server_name=peer_name, instructions_template=None)
+
+@bp.route('/peers/<peer_name>/<lab_name>/', methods=['GET', 'POST'])
+@login_required
+def book_peer_lab(peer_name, lab_name):
+    lab = get_remote_lab(peer_name, lab_name)
+    if lab is None:
+        flash(f'Lab not found or {peer_name} not available.', 'error')
+        return redirect(url_for('app.index'))
+    lab_duration = lab['duration']
+
+    form = BookingForm(lab_duration)
+    if form.validate_on_submit():
+        user_datetime = datetime.fromisoformat(form.date_time.data)
+        formatted_user_datetime = user_datetime.strftime('%d/%m/%Y @ %H:%Mh')
         try:
-            r = requests.get(f'http://127.0.0.1:{host_port}', timeout=1)
-            if 200 <= r.status_code < 500:
-                break
-        except requests.RequestException:
-            pass
-        time.sleep(0.5)
-
-    return redirect(lab_url)
+            status_code, resp = federation.book_peer_lab(peer_name, lab_name, current_user.email,
+                                              user_datetime.isoformat())
+        except (requests.RequestException, ValueError):
+            flash(f'{peer_name} is not available, please try again later.', 'error')
+            return redirect(url_for('app.book_peer_lab', peer_name=peer_name, lab_name=lab_name))
+        if status_code == 201:
+            flash(f'{lab["html_name"]} reserved successfully for {formatted_user_datetime}', 'success')
+        elif status_code == 409:
+            flash('Someone else just booked that slot, please select a different one.', 'error')
+        else:
+            flash(resp.get('error', 'The Lab could not be reserved.'), 'error')
+        return redirect(url_for('app.book_peer_lab', peer_name=peer_name, lab_name=lab_name))
+
+    tpl_kwargs = {
+        'lab': lab,
+        'lab_duration': lab_duration,
+        'enter_url': federation.get_peer_url(peer_name, f'/enter/{lab_name}/'),
+        'user_email': current_user.email,
+        'form': form,
+    }
+    return render_template('book_lab.html', **tpl_kwargs)
+
+@bp.route('/peers/<peer_name>/<lab_name>/slots')
+@login_required
+def get_peer_slots(peer_name, lab_name):
+    if federation.get_peer_lab(peer_name, lab_name) is None:
+        return jsonify({'error': 'Lab not found.'}), 404
+    start_dt, days = parse_slots_range()
+    if start_dt is None:
+        return jsonify({'error': 'Invalid start date or number of days.'}), 400
+    try:
+        status_code, slots = federation.get_peer_slots(peer_name, lab_name, start_dt.isoformat(), days,
+                                            current_user.email)
+    except (requests.RequestException, ValueError):
+        return jsonify({'error': f'{peer_name} is not available.'}), 504
+    return jsonify(slots), status_code
+
+@bp.route('/peers/<peer_name>/<lab_name>/check_slot')
+@login_required
+def check_peer_slot(peer_name, lab_name):
+    if federation.get_peer_lab(peer_name, lab_name) is None:
+        return jsonify('Lab not found.')
+    user_datetime = datetime.fromisoformat(request.args.get('user_datetime'))
+    formatted_user_datetime = user_datetime.strftime('%d/%m/%Y @ %H:%Mh')
+    # the first slot of the range is the selected one
+    try:
+        status_code, slots = federation.get_peer_slots(peer_name, lab_name, user_datetime.isoformat(), 1,
+                                            current_user.email)
+    except (requests.RequestException, ValueError):
+        return jsonify(f'{peer_name} is not available, please try again later.')
+    if status_code != 200:
+        return jsonify(slots.get('error', 'The Lab could not be checked.'))
+    return jsonify(get_slot_message(slots['slots'][0]['state'], formatted_user_datetime))
+
+# Prometheus metrics of all the gunicorn workers
+@bp.route('/metrics')
+def metrics():
+    def count_sessions():
+        return db.session.query(LabSession.status, db.func.count(LabSession.id)).filter(
+            LabSession.status.in_(ACTIVE_STATUS)).group_by(LabSession.status).all()
+    data, content_type = render_metrics(count_sessions)
+    return Response(data, content_type=content_type)
@@ -0,0 +1,366 @@
+import fcntl
+import heapq
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import docker
+from sqlalchemy.exc import IntegrityError
+
+from in4labs_app import db, get_registry, reload_registry_if_changed
+from in4labs_app.metrics import observe_docker_call
+from in4labs_app.auth.models import User
+from .models import Booking, LabSession
+from .docker_state import registry, get_docker_client
+from .session_logs import SessionLogWriter, LogStreamTask, lock_log_stream, remove_log_stream
+from .archive import archive_bookings
+from .analytics import rollup_usage, get_rolled_up_until
+from .utils import set_session_status, set_session_ready, set_session_stopped, get_session_container_names, \
+    stop_previous_containers, run_lab_containers, wait_lab_ready, get_session_volume_names, \
+    remove_session_volumes, session_volume_label, bump_slots_version
+
+
+ACTIVE_STATUS = ('starting', 'ready', 'entered')
+
+launch_executor = ThreadPoolExecutor(max_workers=len(get_registry().mountings))
+
+def claim_lab_session(booking, lab, mounting):
+    # Only one worker/thread can create the session of a booking (unique booking_id)
+    start_dt = booking.date_time.replace(tzinfo=timezone.utc)
+    session = LabSession(
+        booking_id=booking.id,
+        mounting_id=lab['mounting_id'],
+        lab_name=lab['lab_name'],
+        status='starting',
+        started_at=datetime.now(timezone.utc),
+        start_time=start_dt,
+        end_time=start_dt + timedelta(minutes=mounting['duration'])
+    )
+    db.session.add(session)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return session
+
+def start_lab_session(client, session, lab, mounting, user_email, ready_timeout):
+    start_dt = session.start_time.replace(tzinfo=timezone.utc)
+    # Check if there is any previous container running in the mounting and stop it
+    stop_previous_containers(client, get_registry().mounting_labs[lab['mounting_id']])
+    try:
+        # (session id, booking id) to follow the logs of the Lab container from its start
+        run_lab_containers(client, lab, mounting, start_dt, user_email, (session.id, session.booking_id))
+    except Exception: # the containers already started were stopped
+        set_session_stopped(session.id)
+        raise
+
+    # The containers are stopped by the LabScheduler at the end of the time slot
+    with observe_docker_call('wait_lab_ready'):
+        ready = wait_lab_ready(mounting['host_port'], ready_timeout)
+    if not ready:
+        print(f'Lab web server of booking {session.booking_id} not ready after {ready_timeout}s.')
+    set_session_ready(session.id)
+    return ready
+
+def launch_lab_session(app, session_id, lab, mounting, user_email, ready_timeout):
+    # Start the containers and probe the Lab web server outside the request
+    launch_executor.submit(_launch_lab_session, app, session_id, lab, mounting, user_email, ready_timeout)
+
+def _launch_lab_session(app, session_id, lab, mounting, user_email, ready_timeout):
+    with app.app_context():
+        try:
+            session = db.session.get(LabSession, session_id)
+            start_lab_session(get_docker_client(), session, lab, mounting, user_email, ready_timeout)
+        except Exception as e:
+            print(f'Error starting lab containers: {e}')
+        finally:
+            db.session.remove()
+
+def stop_lab_session(client, session, from_status):
+    if not set_session_status(session.id, 'stopped', from_status, stopped_at=datetime.now(timezone.utc)):
+        return
+    lab = get_registry().labs.get(session.lab_name)
+    if lab is None: # removed from the labs configuration
+        return
+    container_names = get_session_container_names(lab, session)
+    for container_name in container_names:
+        if not registry.is_running(container_name):
+            continue
+        try:
+            with observe_docker_call('containers.stop'):
+                client.containers.get(container_name).stop()
+        except docker.errors.NotFound:
+            pass
+    print(f'Lab containers of booking {session.booking_id} stopped.')
+
+
+class LabScheduler(threading.Thread):
+    # Only one gunicorn worker per host runs the scheduler (file lock), the others
+    # wait to take over. Pending stops are the active LabSession rows in the db.
+    def __init__(self, app):
+        super(LabScheduler, self).__init__(daemon=True)
+        self.app = app
+        self.lock_path = app.config['LAB_SCHEDULER_LOCK']
+        self.prewarm_secs = app.config['LAB_PREWARM_SECONDS']
+        self.no_show_mins = app.config['LAB_NO_SHOW_MINUTES']
+        self.ready_timeout = app.config['LAB_READY_TIMEOUT']
+        self.interval = app.config['LAB_SCHEDULER_INTERVAL']
+        self.lock_file = None
+        self.jobs = [] # heap of (run_at, job, session_id)
+        self.cleanup_secs = 10 # remove the session volumes after the containers
+        # Launches still not ready after the ready timeout and the container starts were lost
+        # (e.g. the worker that ran them was recycled)
+        self.lost_launch_secs = self.ready_timeout + 120
+        self.scheduled = set() # sessions with pending jobs
+        self.log_streams = {} # session_id -> LogStreamTask
+        self.logs_dir = app.config['LAB_LOGS_DIR']
+        self.logs_max_bytes = app.config['LAB_LOGS_MAX_BYTES']
+        self.logs_max_secs = app.config['LAB_LOGS_MAX_SECONDS']
+        self.archive_days = app.config['BOOKING_ARCHIVE_DAYS']
+        self.archive_interval = app.config['BOOKING_ARCHIVE_INTERVAL']
+        self.next_archive = 0
+        self.rollup_interval = app.config['USAGE_ROLLUP_INTERVAL']
+        self.next_rollup = 0
+
+    def acquire_lock(self):
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file # keep it open to hold the lock
+        return True
+
+    def run(self):
+        while not self.acquire_lock():
+            time.sleep(self.interval)
+        print(f'Lab scheduler running in process {os.getpid()}.')
+
+        reconciled = False
+        next_poll = 0
+        while True:
+            with self.app.app_context():
+                try:
+                    client = get_docker_client()
+                    if not reconciled:
+                        self.reconcile(client)
+                        reconciled = True
+                    if time.time() >= next_poll:
+                        reload_registry_if_changed(self.app.config['LABS_RELOAD_INTERVAL'])
+                        self.load_sessions()
+                        self.stream_logs(client)
+                        self.stop_lost_launches(client)
+                        if self.prewarm_secs:
+                            self.prewarm_sessions()
+                        if time.time() >= self.next_rollup:
+                            self.rollup()
+                        if self.archive_days and time.time() >= self.next_archive:
+                            self.archive()
+                        next_poll = time.time() + self.interval
+                    self.run_jobs(client)
+                except Exception as e:
+                    print(f'Lab scheduler error: {e}')
+                    next_poll = time.time() + self.interval
+                finally:
+                    db.session.remove()
+            # Sleep until the next poll or the next job
+            sleep_secs = next_poll - time.time()
+            if self.jobs:
+                sleep_secs = min(sleep_secs, self.jobs[0][0] - time.time())
+            time.sleep(max(sleep_secs, 0))
+
+    def reconcile(self, client):
+        # Compare the pending sessions with the running containers after a (re)start
+        running = registry.running_names()
+        registry_labs = get_registry().labs
+        active_names = set()
+        active_volumes = set()
+        for session in LabSession.query.filter(LabSession.status.in_(ACTIVE_STATUS)).all():
+            lab = registry_labs.get(session.lab_name)
+            if lab is None:
+                set_session_stopped(session.id)
+                continue
+            container_names = get_session_container_names(lab, session)
+            # The Lab container is gone (e.g. the host was restarted). Launches that never
+            # finish are stopped later by stop_lost_launches
+            if session.status != 'starting' and container_names[-1] not in running:
+                set_session_stopped(session.id)
+                continue
+            active_names.update(container_names)
+            active_volumes.update(get_session_volume_names(lab, session.start_time.replace(tzinfo=timezone.utc)))
+        # Stop orphan containers not belonging to any pending session
+        prefixes = tuple(l['container_prefix'] for l in registry_labs.values())
+        extra_names = [c['name'] for l in registry_labs.values() for c in l['extra_containers']]
+        for name in running:
+            if name in active_names:
+                continue
+            if name.startswith(prefixes) or name in extra_names:
+                print(f'Stopping orphan container {name}.')
+                try:
+                    client.containers.get(name).stop()
+                except docker.errors.NotFound:
+                    pass
+        # Remove the volumes of stopped sessions (e.g. the cleanup job was lost in a restart)
+        for volume in client.volumes.list(filters={'label': session_volume_label}):
+            if volume.name in active_volumes:
+                continue
+            try:
+                volume.remove()
+            except docker.errors.APIError as e:
+                print(f'Session volume {volume.name} not removed: {e}')
+
+    def load_sessions(self):
+        # Schedule the jobs of new sessions (created by any worker)
+        for session in LabSession.query.filter(LabSession.status.in_(ACTIVE_STATUS)).all():
+            if session.id in self.scheduled:
+                continue
+            self.scheduled.add(session.id)
+            start_ts = session.start_time.replace(tzinfo=timezone.utc).timestamp()
+            end_ts = session.end_time.replace(tzinfo=timezone.utc).timestamp()
+            # Minus 3 seconds to avoid conflicts with the next time slot container
+            heapq.heappush(self.jobs, (end_ts - 3, 'stop', session.id))
+            if session.entered_at is None:
+                heapq.heappush(self.jobs, (start_ts + self.no_show_mins * 60, 'no_show', session.id))
+
+    def stop_lost_launches(self, client):
+        # Stop them, so lab_status reports the error and enter_lab launches them again
+        started_before = datetime.now(timezone.utc) - timedelta(seconds=self.lost_launch_secs)
+        sessions = LabSession.query.filter(
+            LabSession.status.in_(ACTIVE_STATUS),
+            LabSession.ready_at.is_(None),
+            LabSession.started_at < started_before
+        ).all()
+        for session in sessions:
+            print(f'Launch of booking {session.booking_id} lost, stopping its session.')
+            stop_lab_session(client, session, ACTIVE_STATUS)
+            heapq.heappush(self.jobs, (time.time() + self.cleanup_secs, 'cleanup', session.id))
+
+    def stream_logs(self, client):
+        # Capture the logs of the running Lab containers, also after a scheduler takeover
+        registry_labs = get_registry().labs
+        sessions = LabSession.query.filter(LabSession.status.in_(ACTIVE_STATUS)).all()
+        active_ids = {session.id for session in sessions}
+        for session_id in list(self.log_streams):
+            if session_id not in active_ids:
+                del self.log_streams[session_id]
+        for session in sessions:
+            if session.id in self.log_streams:
+                continue
+            lab = registry_labs.get(session.lab_name)
+            if lab is None:
+                continue
+            container_name = get_session_container_names(lab, session)[-1]
+            if not registry.is_running(container_name):
+                continue
+            # Usually followed since its start by the process that launched it
+            lock_fd = lock_log_stream(self.logs_dir, session.id)
+            if lock_fd is None:
+                continue
+            try:
+                container = client.containers.get(container_name)
+            except docker.errors.NotFound:
+                os.close(lock_fd)
+                continue
+            booking = db.session.get(Booking, session.booking_id)
+            user = db.session.get(User, booking.user_id) if booking else None
+            writer = SessionLogWriter(self.logs_dir, session.lab_name, session.booking_id,
+                                      user.email if user else '', self.logs_max_bytes, self.logs_max_secs)
+            task = LogStreamTask(container, writer, lock_fd)
+            task.start()
+            self.log_streams[session.id] = task
+
+    def run_jobs(self, client):
+        while self.jobs and self.jobs[0][0] <= time.time():
+            _, job, session_id = heapq.heappop(self.jobs)
+            session = db.session.get(LabSession, session_id)
+            if session is None:
+                continue
+            if job == 'stop':
+                self.scheduled.discard(session_id)
+                stop_lab_session(client, session, ACTIVE_STATUS)
+                heapq.heappush(self.jobs, (time.time() + self.cleanup_secs, 'cleanup', session_id))
+            elif job == 'no_show' and session.entered_at is None:
+                # Prewarmed containers nobody entered
+                stop_lab_session(client, session, ('ready',))
+                heapq.heappush(self.jobs, (time.time() + self.cleanup_secs, 'cleanup', session_id))
+            elif job == 'cleanup' and session.status == 'stopped':
+                self.cleanup_session(client, session)
+
+    def cleanup_session(self, client, session):
+        remove_log_stream(self.logs_dir, session.id)
+        lab = get_registry().labs.get(session.lab_name)
+        if lab is None:
+            return
+        try:
+            remove_session_volumes(client, lab, session.start_time.replace(tzinfo=timezone.utc))
+        except docker.errors.APIError as e:
+            # Still in use, retry while the session volumes are recent
+            end_ts = session.end_time.replace(tzinfo=timezone.utc).timestamp()
+            if time.time() < end_ts + 3600:
+                heapq.heappush(self.jobs, (time.time() + 30, 'cleanup', session.id))
+            else:
+                print(f'Session volumes of booking {session.booking_id} not removed: {e}')
+
+    def rollup(self):
+        self.next_rollup = time.time() + self.rollup_interval
+        # The time slots of the previous hour ended, and their sessions are already stopped
+        until_dt = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0, tzinfo=None) - \
+            timedelta(hours=1)
+        added = rollup_usage(until_dt)
+        if added:
+            print(f'{added} bookings added to the usage rollups.')
+
+    def archive(self):
+        self.next_archive = time.time() + self.archive_interval
+        before_dt = datetime.now(timezone.utc) - timedelta(days=self.archive_days)
+        # Only the bookings already in the usage rollups
+        rolled_up_until = get_rolled_up_until()
+        if rolled_up_until is None:
+            return
+        before_dt = min(before_dt, rolled_up_until.replace(tzinfo=timezone.utc))
+        archived = archive_bookings(before_dt)
+        if archived:
+            print(f'{archived} bookings archived.')
+            for mounting_id in get_registry().mountings:
+                bump_slots_version(mounting_id)
+
+    def prewarm_sessions(self):
+        now = datetime.now(timezone.utc)
+        registry_labs = get_registry().labs
+        for mounting in get_registry().mountings.values():
+            lab_duration = mounting['duration']
+            # The previous time slot containers are still running
+            active = LabSession.query.filter(
+                LabSession.mounting_id == mounting['id'],
+                LabSession.status.in_(ACTIVE_STATUS)
+            ).first()
+            if active:
+                continue
+
+            start_minute = now.minute - (now.minute % lab_duration)
+            start_dt = now.replace(minute=start_minute, second=0, microsecond=0)
+            start_dt = max(start_dt, now - timedelta(minutes=self.no_show_mins))
+            booking = Booking.query.outerjoin(
+                LabSession, LabSession.booking_id == Booking.id
+            ).filter(
+                LabSession.id.is_(None),
+                Booking.mounting_id == mounting['id'],
+                Booking.date_time >= start_dt,
+                Booking.date_time <= now + timedelta(seconds=self.prewarm_secs)
+            ).order_by(Booking.date_time).first()
+            if booking is None:
+                continue
+
+            lab = registry_labs.get(booking.lab_name)
+            user = db.session.get(User, booking.user_id)
+            if lab is None or user is None:
+                continue
+            session = claim_lab_session(booking, lab, mounting)
+            if session is None: # claimed by another worker
+                continue
+            print(f'Prewarming lab containers of booking {booking.id}.')
+            launch_lab_session(self.app, session.id, lab, mounting, user.email, self.ready_timeout)
@@ -0,0 +1,134 @@
+import fcntl
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+from in4labs_app.metrics import log_bytes
+
+
+class SessionLogWriter(object):
+    # Write the log lines of a session as JSON lines, rotating the file by size or age.
+    # Closed files are compressed with gzip.
+    def __init__(self, log_dir, lab_name, booking_id, user_email, max_bytes, max_secs):
+        day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        self.log_dir = os.path.join(log_dir, lab_name, day)
+        os.makedirs(self.log_dir, exist_ok=True)
+        user = re.sub(r'[^\w.@-]', '_', user_email)
+        self.base_name = f'{booking_id}_{user}'
+        self.booking_id = booking_id
+        self.user_email = user_email
+        self.max_bytes = max_bytes
+        self.max_secs = max_secs
+        self.part = 0
+        self.file = None
+
+    def open(self):
+        # Don't overwrite the parts of a previous writer of the same session
+        while os.path.exists(self.part_path() + '.gz') or os.path.exists(self.part_path()):
+            self.part += 1
+        self.file = open(self.part_path(), 'a')
+        self.opened_at = time.time()
+        self.size = 0
+
+    def part_path(self):
+        return os.path.join(self.log_dir, f'{self.base_name}.{self.part}.jsonl')
+
+    def write(self, log_time, line):
+        if self.file is None:
+            self.open()
+        record = json.dumps({
+            'time': log_time,
+            'booking_id': self.booking_id,
+            'user': self.user_email,
+            'line': line,
+        })
+        self.file.write(record + '\n')
+        self.file.flush()
+        self.size += len(record) + 1
+        log_bytes.inc(len(record) + 1)
+        if self.size >= self.max_bytes or time.time() - self.opened_at >= self.max_secs:
+            self.close()
+        return len(record) + 1
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        path = self.part_path()
+        with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(path)
+        self.part += 1
+
+
+def lock_log_stream(log_dir, session_id):
+    # Only one process follows the logs of a session: the one holding the lock of its stream
+    # file, released if the process dies. The file keeps the time of the last line written
+    streams_dir = os.path.join(log_dir, '.streams')
+    os.makedirs(streams_dir, exist_ok=True)
+    fd = os.open(os.path.join(streams_dir, f'{session_id}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+def remove_log_stream(log_dir, session_id):
+    # Once the session is stopped and its stream finished
+    try:
+        os.remove(os.path.join(log_dir, '.streams', f'{session_id}.lock'))
+    except FileNotFoundError:
+        pass
+
+def get_log_time_key(log_time):
+    # Docker timestamps (RFC 3339, UTC) drop the trailing zeros of the nanoseconds
+    seconds, _, nanos = log_time.rstrip('Z').partition('.')
+    return seconds, nanos.ljust(9, '0')
+
+
+class LogStreamTask(threading.Thread):
+    # Follow the Lab container logs until it stops, so nothing is lost if it dies early.
+    # A task that takes over the stream of another process continues after its last line
+    def __init__(self, container, writer, lock_fd):
+        super(LogStreamTask, self).__init__(daemon=True)
+        self.container = container
+        self.writer = writer
+        self.lock_fd = lock_fd
+        self.last_time = os.pread(lock_fd, 64, 0).decode().strip() or None
+
+    def run(self):
+        pending = b''
+        try:
+            kwargs = {}
+            if self.last_time:
+                seconds, nanos = get_log_time_key(self.last_time)
+                since = datetime.fromisoformat(seconds).replace(tzinfo=timezone.utc)
+                kwargs['since'] = since.timestamp() + int(nanos[:6]) / 1e6
+            for chunk in self.container.logs(stream=True, follow=True, timestamps=True, **kwargs):
+                pending += chunk
+                *lines, pending = pending.split(b'\n')
+                for line in lines:
+                    self.write_line(line)
+            if pending:
+                self.write_line(pending)
+        except Exception as e:
+            print(f'Error streaming logs of {self.container.name}: {e}')
+        finally:
+            self.writer.close()
+            os.close(self.lock_fd)
+
+    def write_line(self, line):
+        # Lines start with the Docker timestamp, the ones already written by a previous task are skipped
+        log_time, _, text = line.decode('utf-8', errors='replace').partition(' ')
+        if self.last_time and get_log_time_key(log_time) <= get_log_time_key(self.last_time):
+            return
+        self.writer.write(log_time, text.rstrip('\r'))
+        self.last_time = log_time
+        os.pwrite(self.lock_fd, log_time.encode().ljust(64), 0)
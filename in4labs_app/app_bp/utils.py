@@ -1,64 +1,367 @@
+import hmac
+import io
 import os
 import re
-import threading
+import socket
+import tarfile
 import time
-from datetime import datetime, timezone
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
 
-from flask import redirect, url_for, flash
+from functools import partial, wraps
+
+from flask import current_app, abort, request
+from flask_login import current_user, login_required
 
 import bcrypt
+import docker
+import requests
+
+from in4labs_app import db, cache, basedir, server_name, get_registry
+from in4labs_app.metrics import observe_docker_call, enter_to_ready_seconds, container_start_seconds
+from .models import LabSession
+from .docker_state import registry
+from .cam_relay import is_hls
+from .session_logs import SessionLogWriter, LogStreamTask, lock_log_stream
+
+
+session_volume_label = 'in4labs.session_volume' # volume of the lab config
+
+# Containers of a Lab started at the same time
+container_executor = ThreadPoolExecutor(max_workers=4)
+
+
+def get_lab(lab_name):
+    return get_registry().labs.get(lab_name)
+
+def admin_required(f):
+    # Only the users in the ADMIN_EMAILS setting can access the view
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if current_user.email not in current_app.config['ADMIN_EMAILS']:
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+def peer_required(f):
+    # Only the federation peers, with the shared FEDERATION_TOKEN, can access the view
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = current_app.config['FEDERATION_TOKEN']
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get('X-In4Labs-Token', ''), token):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+def get_slots_version(mounting_id):
+    # Changes with each booking or cancellation in the mounting. In the cache shared by
+    # the workers, so all of them stop using the cached availability at once
+    key = f'slots_version:{mounting_id}'
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, timeout=0): # set by another worker
+            version = cache.get(key) or version
+    return version
+
+def bump_slots_version(mounting_id):
+    cache.set(f'slots_version:{mounting_id}', uuid.uuid4().hex, timeout=0)
+
+def set_session_status(session_id, status, from_status, **values):
+    # Atomic update of the session status, so only one worker/thread changes it
+    values['status'] = status
+    updated = LabSession.query.filter(
+        LabSession.id == session_id,
+        LabSession.status.in_(from_status)
+    ).update(values, synchronize_session=False)
+    db.session.commit()
+    return updated == 1
+
+def set_session_stopped(session_id):
+    return set_session_status(session_id, 'stopped', ('starting', 'ready', 'entered'),
+                              stopped_at=datetime.now(timezone.utc))
+
+def set_session_ready(session_id):
+    # The Lab web server responds, also when the user already entered
+    now = datetime.now(timezone.utc)
+    LabSession.query.filter_by(id=session_id).update({'ready_at': now}, synchronize_session=False)
+    db.session.commit()
+    entered_at = db.session.query(LabSession.entered_at).filter_by(id=session_id).scalar()
+    if entered_at is not None: # the user is waiting in lab_starting
+        enter_to_ready_seconds.observe((now - entered_at.replace(tzinfo=timezone.utc)).total_seconds())
+    set_session_status(session_id, 'ready', ('starting',))
+
+def get_container_name(lab_name, start_dt):
+    # Create a unique container name with the lab name and the start date time
+    return f'{lab_name.lower()}-{start_dt.strftime("%Y%m%d%H%M")}'
+
+def get_session_container_names(lab, session):
+    # Extra containers first, the last one is the Lab container
+    start_dt = session.start_time.replace(tzinfo=timezone.utc)
+    container_names = [c['name'] for c in lab['extra_containers']]
+    container_names.append(get_container_name(lab['lab_name'], start_dt))
+    return container_names
+
+def stop_previous_containers(client, labs):
+    # Stop the lab and extra containers of previous time slots that are still running
+    prefixes = tuple(lab['container_prefix'] for lab in labs)
+    extra_names = [c['name'] for lab in labs for c in lab['extra_containers']]
+    for name in registry.running_names():
+        if name.startswith(prefixes) or name in extra_names:
+            try:
+                with observe_docker_call('containers.stop'):
+                    client.containers.get(name).stop()
+            except docker.errors.NotFound:
+                pass
+
+def run_extra_container(client, lab, extra_container, start_dt, user_email):
+    if extra_container['name'] == 'node-red':
+        nodered_dir = os.path.join(basedir, 'labs', lab['lab_name'], 'node-red')
+        with observe_docker_call('setup_node_red'):
+            return run_node_red_container(client, extra_container, nodered_dir, start_dt, user_email)
+
+    with observe_docker_call('containers.run'):
+        return client.containers.run(
+                        extra_container['image'], 
+                        name=extra_container["name"],
+                        detach=True,
+                        remove=True,
+                        ports=extra_container['ports'],
+                        volumes=extra_container.get('volumes', {}),
+                        network=extra_container.get('network', ''),
+                        command=extra_container.get('command', ''))
 
+def get_cam_url(mounting):
+    # URL of the webcam relay, in the same host as the Lab (LAB_PROXY or external proxy)
+    if not current_app.config['CAM_RELAY']:
+        return mounting['cam_url']
+    cam_url = f'/{server_name}/cam/{mounting["id"]}/'
+    if is_hls(mounting['cam_url']):
+        cam_url += mounting['cam_url'].split('?')[0].rsplit('/', 1)[1]
+    return cam_url
 
-class StopContainersTask(threading.Thread):
-     def __init__(self, lab_name, containers, end_time, user_email):
-         super(StopContainersTask, self).__init__()
-         self.lab_name = lab_name
-         self.containers = containers
-         self.end_time = end_time
-         self.user_email = user_email
- 
-     def run(self):
-        remaining_secs = (self.end_time - datetime.now(timezone.utc)).total_seconds()
-        # Minus 3 seconds to avoid conflicts with the next time slot container
-        time.sleep(remaining_secs - 3)
-        # Save the container lab logs to a file
-        logs = self.containers[-1].logs() # last container is the Lab container
-        logs = logs.decode('utf-8').split('Press CTRL+C to quit')[1]
-        logs = 'USER: ' + self.user_email + logs
-        with open(f'{self.lab_name}_logs_UTC.txt', 'a') as f:
-            f.write(logs)
-        # Stop the containers
-        for container in self.containers:
-            container.stop()
-        print('Lab containers stopped.')
-
-def get_lab(labs, lab_name):
-    for lab in labs:
-        if lab['lab_name'] == lab_name:
-            return lab   
-    flash(f'Lab not found.', 'error')
-    return redirect(url_for('app.index'))
-
-def setup_node_red(client, volume_name, nodered_dir, user_email):
-    # Clean the volume for the new user
-    volume = client.volumes.get(volume_name)
-    volume.remove()
-    client.volumes.create(volume_name)
-    # Set the username and password for the node-red container
-    # Generate bcrypt hash from the user email
-    hashed_password = bcrypt.hashpw(user_email.encode(), bcrypt.gensalt()).decode()
-    # Copy the default settings file
-    settings_default_file = os.path.join(nodered_dir, 'settings_default.js')
-    with open(settings_default_file, 'r') as file:
+def start_log_stream(container, lab_name, log_session, user_email):
+    # Follow the logs of the Lab container from its start, so the output of a Lab that exits
+    # at once is kept (the containers are removed when they stop)
+    session_id, booking_id = log_session
+    config = current_app.config
+    try:
+        lock_fd = lock_log_stream(config['LAB_LOGS_DIR'], session_id)
+        if lock_fd is None: # followed by another process
+            return
+        writer = SessionLogWriter(config['LAB_LOGS_DIR'], lab_name, booking_id, user_email,
+                                  config['LAB_LOGS_MAX_BYTES'], config['LAB_LOGS_MAX_SECONDS'])
+    except OSError as e:
+        print(f'Logs of {container.name} not followed: {e}')
+        return
+    LogStreamTask(container, writer, lock_fd).start()
+
+def run_lab_container(client, lab, mounting, start_dt, user_email, log_session=None):
+    lab_name = lab['lab_name']
+    end_time = start_dt + timedelta(minutes=mounting['duration'])
+    docker_env = {
+        'SERVER_NAME': server_name,
+        'LAB_NAME': lab_name,
+        'USER_EMAIL': user_email,
+        'END_TIME': end_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'CAM_URL': get_cam_url(mounting),
+    }
+
+    with observe_docker_call('containers.run'):
+        container = client.containers.run(
+                        lab['image_name'], 
+                        name=get_container_name(lab_name, start_dt),
+                        detach=True, 
+                        remove=True,
+                        privileged=True,
+                        #devices=['/dev/ttyACM[0-9]*:/dev/ttyACM[0-9]*:rwm'],
+                        volumes=dict(lab['volumes']),
+                        ports=dict(lab['ports']), 
+                        environment=docker_env)
+    if log_session is not None:
+        start_log_stream(container, lab_name, log_session, user_email)
+    return container
+
+def is_container_healthy(container, healthcheck):
+    try:
+        if 'port' in healthcheck:
+            with socket.create_connection(('127.0.0.1', healthcheck['port']), timeout=1):
+                return True
+        if 'http' in healthcheck:
+            return 200 <= requests.get(healthcheck['http'], timeout=1).status_code < 400
+        if 'log' in healthcheck:
+            logs = container.logs(tail=200).decode('utf-8', errors='replace')
+            return healthcheck['log'] in logs
+    except (OSError, requests.RequestException, docker.errors.APIError):
+        return False
+    return True
+
+def wait_container_healthy(container, healthcheck):
+    # Wait for the open port, the HTTP response or the log line of the healthcheck
+    timeout = healthcheck.get('timeout', 30)
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if is_container_healthy(container, healthcheck):
+            return True
+        time.sleep(0.25)
+    print(f'Container {container.name} not healthy after {timeout}s.')
+    return False
+
+def start_container(app, name, run_container, healthcheck):
+    with app.app_context():
+        start_time = time.perf_counter()
+        container = run_container()
+        healthy = wait_container_healthy(container, healthcheck) if healthcheck else True
+        secs = time.perf_counter() - start_time
+        container_start_seconds.labels(name).observe(secs)
+        return container, healthy, secs
+
+def stop_started_containers(containers):
+    for container in containers:
+        try:
+            with observe_docker_call('containers.stop'):
+                container.stop()
+        except docker.errors.APIError: # NotFound too
+            pass
+
+def run_lab_containers(client, lab, mounting, start_dt, user_email, log_session=None):
+    # Start the containers as a dependency graph: the ones without pending dependencies run
+    # in parallel and the others wait for their healthchecks. The lab container goes last.
+    # If a container fails or is not healthy, the rest are not started and the started ones
+    # are stopped
+    app = current_app._get_current_object()
+    lab_name = lab['lab_name']
+    pending = {}
+    for extra_container in lab['extra_containers']:
+        run_container = partial(run_extra_container, client, lab, extra_container, start_dt, user_email)
+        pending[extra_container['name']] = (extra_container['depends_on'], run_container,
+                                            extra_container.get('healthcheck'))
+    run_container = partial(run_lab_container, client, lab, mounting, start_dt, user_email, log_session)
+    pending[lab_name] = (tuple(pending), run_container, None)
+
+    started = {}
+    timings = {}
+    futures = {}
+    error = None
+    while futures or (pending and error is None):
+        if error is None:
+            for name, (depends_on, run_container, healthcheck) in list(pending.items()):
+                if all(dependency in started for dependency in depends_on):
+                    future = container_executor.submit(start_container, app, name, run_container, healthcheck)
+                    futures[future] = name
+                    del pending[name]
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = futures.pop(future)
+            try:
+                container, healthy, timings[name] = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            started[name] = container
+            if not healthy:
+                error = error or RuntimeError(f'Container {name} of {lab_name} not healthy.')
+
+    if error is not None:
+        # The running starts have finished, the pending ones were never submitted
+        stop_started_containers(started.values())
+        raise error
+
+    print(f'Lab containers of {lab_name} started in ' +
+          ', '.join(f'{name} {secs:.1f}s' for name, secs in timings.items()))
+    return list(started.values())
+
+def wait_lab_ready(host_port, timeout):
+    # Wait up to timeout seconds for the container’s web server to respond
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        try:
+            r = requests.get(f'http://127.0.0.1:{host_port}', timeout=1)
+            if 200 <= r.status_code < 500:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+def get_session_volume_name(volume_name, start_dt):
+    return f'{volume_name}-{start_dt.strftime("%Y%m%d%H%M")}'
+
+def get_node_red_password_hash(user_email):
+    # bcrypt takes about a second on a Raspberry Pi, so hash the password of each user once
+    key = f'nodered:{user_email}'
+    hashed_password = cache.get(key)
+    if hashed_password is None:
+        hashed_password = bcrypt.hashpw(user_email.encode(), bcrypt.gensalt()).decode()
+        cache.set(key, hashed_password, timeout=0)
+    return hashed_password
+
+def render_node_red_settings(nodered_dir, user_email):
+    with open(os.path.join(nodered_dir, 'settings_default.js'), 'r') as file:
         js_content = file.read()
     # Use regular expressions to find and replace the username and password
     username_pattern = r'username:\s*"[^"]*"'
     password_pattern = r'password:\s*"[^"]*"'
     new_username_line = f'username: "{user_email}"'
-    new_password_line = f'password: "{hashed_password}"'
-    js_content = re.sub(username_pattern, new_username_line, js_content)
-    js_content = re.sub(password_pattern, new_password_line, js_content)
-    # Write the modified content in a settings.js file
-    settings_file = os.path.join(nodered_dir, 'settings.js')
-    with open(settings_file, 'w') as file:
-        file.write(js_content)
+    new_password_line = f'password: "{get_node_red_password_hash(user_email)}"'
+    js_content = re.sub(username_pattern, lambda m: new_username_line, js_content)
+    js_content = re.sub(password_pattern, lambda m: new_password_line, js_content)
+    return js_content
+
+def create_tar(files):
+    # Tar archive in memory for put_archive, owned by the node-red user of the image
+    tar_data = io.BytesIO()
+    with tarfile.open(fileobj=tar_data, mode='w') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            info.uid = info.gid = 1000
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(content))
+    return tar_data.getvalue()
+
+def run_node_red_container(client, extra_container, nodered_dir, start_dt, user_email):
+    # Each session gets a new volume, so nothing is removed before the Lab starts: Docker fills it
+    # with the data folder of the image and the optional baseline.tar of the Lab is copied over it.
+    # The settings file of the user goes inside the volume. Old volumes are removed by the LabScheduler
+    volumes = dict(extra_container['volumes'])
+    volume_name = list(volumes.keys())[0]
+    data_bind = volumes.pop(volume_name)
+    session_volume_name = get_session_volume_name(volume_name, start_dt)
+    client.volumes.create(session_volume_name, labels={session_volume_label: volume_name})
+    volumes[session_volume_name] = data_bind
+
+    container = client.containers.create(
+                    extra_container['image'],
+                    name=extra_container['name'],
+                    detach=True,
+                    auto_remove=True,
+                    ports=extra_container['ports'],
+                    volumes=volumes,
+                    network=extra_container.get('network', ''),
+                    command=extra_container.get('command', ''))
+    baseline_path = os.path.join(nodered_dir, 'baseline.tar')
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'rb') as file:
+            container.put_archive(data_bind['bind'], file.read())
+    settings = render_node_red_settings(nodered_dir, user_email)
+    container.put_archive(data_bind['bind'], create_tar({'settings.js': settings.encode()}))
+    container.start()
+    return container
+
+def get_session_volume_names(lab, start_dt):
+    return [get_session_volume_name(list(c['volumes'].keys())[0], start_dt)
+            for c in lab['extra_containers'] if c['name'] == 'node-red']
+
+def remove_session_volumes(client, lab, start_dt):
+    # Raises docker.errors.APIError while the containers are being removed
+    for volume_name in get_session_volume_names(lab, start_dt):
+        try:
+            client.volumes.get(volume_name).remove()
+        except docker.errors.NotFound:
+            pass
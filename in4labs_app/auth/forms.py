@@ -12,6 +12,7 @@ class LoginForm(FlaskForm):
         user = User.query.filter_by(email=email.data).first()
         if user is None or not user.check_password(self.password.data):
             raise ValidationError('Invalid e-mail address or password.')
+        self.user = user # used by the login route, so the user is only queried once
 
 class RegistrationForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired()])
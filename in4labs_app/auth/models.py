@@ -1,21 +1,86 @@
+import threading
+
+from flask import abort, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
-from in4labs_app import db, login
+from in4labs_app import app, db, login, cache
+
+
+# Password hashing is CPU bound, so limit the concurrent hashes of a worker and the logins
+# waiting for them, to avoid a burst of logins taking all the threads of the worker (gthread
+# workers, see gunicorn.conf.py)
+hash_slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_WORKERS'])
+hash_waiting = threading.BoundedSemaphore(app.config['PASSWORD_HASH_WORKERS'] +
+                                          app.config['PASSWORD_HASH_QUEUE'])
+hash_prefix = None # of the hashes created with PASSWORD_HASH_METHOD, with its default parameters
+
+
+def run_password_hash(function, *args):
+    if not hash_waiting.acquire(blocking=False):
+        abort(Response('Too many logins at the same time, please try again.', status=503,
+                       headers={'Retry-After': '2'}))
+    try:
+        with hash_slots:
+            return function(*args)
+    finally:
+        hash_waiting.release()
+
+def try_password_hash(function, *args):
+    # Only if a hash slot is free, None otherwise
+    if not hash_slots.acquire(blocking=False):
+        return None
+    try:
+        return function(*args)
+    finally:
+        hash_slots.release()
+
+def get_hash_prefix():
+    # Werkzeug adds the default parameters to the method (e.g. 'scrypt' -> 'scrypt:32768:8:1')
+    global hash_prefix
+    if hash_prefix is None:
+        with hash_slots:
+            hash_prefix = generate_password_hash('', app.config['PASSWORD_HASH_METHOD']).split('$', 1)[0]
+    return hash_prefix
 
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # Cache the user record to avoid a db query in every authenticated request
+    key = f'user:{id}'
+    user_data = cache.get(key)
+    if user_data is not None:
+        return User(**user_data) # not attached to the db session
+    user = db.session.get(User, int(id))
+    if user is not None:
+        cache.set(key, {'id': user.id, 'email': user.email})
+    return user
+
+def invalidate_user(id):
+    cache.delete(f'user:{id}')
 
 class User(UserMixin,db.Model):
     id=db.Column(db.Integer, primary_key=True, nullable=False, unique=True)
     email=db.Column(db.String(64), nullable=False,unique=True)
     password_hash=db.Column(db.String(256), nullable=False)
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        method = app.config['PASSWORD_HASH_METHOD']
+        self.password_hash = run_password_hash(generate_password_hash, password, method)
+        if self.id is not None:
+            invalidate_user(self.id)
+    def rehash_password(self, password):
+        # After a successful login, skipped if the worker is busy hashing other passwords
+        password_hash = try_password_hash(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+        if password_hash is None:
+            return False
+        self.password_hash = password_hash
+        invalidate_user(self.id)
+        return True
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return run_password_hash(check_password_hash, self.password_hash, password)
+    def password_needs_rehash(self):
+        # The hash was created with different method or parameters (e.g. 'pbkdf2:sha256:600000')
+        return self.password_hash.split('$', 1)[0] != get_hash_prefix()
 
     def __repr__(self):
         return f'<User {self.email}>'
@@ -1,7 +1,7 @@
 from flask import render_template, redirect, url_for
 from .forms import LoginForm, RegistrationForm
 from flask_login import current_user, login_user, logout_user
-from .models import User
+from .models import User, invalidate_user
 from in4labs_app import db
 
 from in4labs_app.auth import bp
@@ -13,7 +13,10 @@ def login():
         return redirect(url_for('app.index'))
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
+        user = form.user
+        # Update the password hash if the hashing settings have changed
+        if user.password_needs_rehash() and user.rehash_password(form.password.data):
+            db.session.commit()
         login_user(user)
         return redirect(url_for('app.index'))
     return render_template('auth/login.html', form=form)
@@ -33,6 +36,7 @@ def register():
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
+        invalidate_user(user.id)
         return redirect(url_for('auth.login'))
 
     return render_template('auth/register.html', form=form)
@@ -1,13 +1,21 @@
+import json
 import os
-from tempfile import mkdtemp
+from tempfile import gettempdir, mkdtemp
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
+# Another server_name in the environment runs another instance of the app in the same host
+# (e.g. to try the federation locally), with its own cache and scheduler lock
+instance_name = os.environ.get('IN4LABS_SERVER_NAME')
+tmp_prefix = f'in4labs_{instance_name}' if instance_name else 'in4labs'
 
 class Config(object): 
     # Flask settings
     ENV = 'development' # change to 'production' to use behind a reverse proxy
-    CACHE_TYPE = 'simple'
+    # Cache of the availability, shared by all gunicorn workers ('SimpleCache' for a single process,
+    # 'RedisCache' with CACHE_REDIS_URL for several hosts)
+    CACHE_TYPE = 'FileSystemCache'
+    CACHE_DIR = os.path.join(gettempdir(), f'{tmp_prefix}_cache')
     CACHE_DEFAULT_TIMEOUT = 600
     SECRET_KEY = 'replace-me', # change in production
     SESSION_TYPE= 'filesystem',
@@ -17,15 +25,52 @@ class Config(object):
     SESSION_COOKIE_SECURE = False   # should be True in case of HTTPS usage (production)
     SESSION_COOKIE_SAMESITE = None  # should be 'None' in case of HTTPS usage (production)
     DEBUG_TB_INTERCEPT_REDIRECTS = False
+    TEMPLATES_AUTO_RELOAD = True # show changes in the lab instructions without a restart
+    JINJA_CACHE_DIR = os.path.join(gettempdir(), 'in4labs_jinja')
+    ADMIN_EMAILS = [] # users allowed to access the admin views
+    METRICS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or \
+        os.path.join(gettempdir(), f'{tmp_prefix}_metrics') # metrics of the gunicorn workers
     
+    # Password settings: method with its parameters, stored hashes with other ones are
+    # updated on login. Lower the iterations for low-power hosts (e.g. 'pbkdf2:sha256:100000')
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:600000'
+    PASSWORD_HASH_WORKERS = 1 # concurrent password hashes per worker
+    PASSWORD_HASH_QUEUE = 4 # logins waiting for a hash per worker, the next ones get a 503
+
     # Database settings
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'in4labs.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLITE_BUSY_TIMEOUT = 5000 # milliseconds
+
+    # Containers settings
+    LAB_PREWARM_SECONDS = 60 # start the Lab containers before the time slot (0 to disable)
+    LAB_NO_SHOW_MINUTES = 5 # stop prewarmed containers if nobody enters the Lab
+    LAB_READY_TIMEOUT = 60 # seconds to wait for the Lab web server of prewarmed containers
+    LAB_SCHEDULER_INTERVAL = 2 # seconds
+    LAB_PROXY = False # serve the Labs through this app (/server_name/lab_name/), only to the user with the booking
+    CAM_RELAY = False # the Labs show the webcams through this app (/server_name/cam/mounting_id/)
+    CAM_RELAY_RING_SIZE = 10 # last frames (MJPEG) or segments (HLS) kept in memory
+    LAB_SCHEDULER_LOCK = os.path.join(gettempdir(), f'{tmp_prefix}_scheduler.lock') # one scheduler per host
+    LAB_LOGS_DIR = os.path.join(os.path.dirname(basedir), 'logs') # Lab containers logs (JSON lines)
+    LAB_LOGS_MAX_BYTES = 5 * 1024 * 1024 # rotate the log files by size...
+    LAB_LOGS_MAX_SECONDS = 3600 # ...or by age
+    BOOKING_ARCHIVE_DAYS = 7 # move older bookings to the archive table (0 to disable)
+    BOOKING_ARCHIVE_INTERVAL = 3600 # seconds between archive runs
+    USAGE_ROLLUP_INTERVAL = 600 # seconds between updates of the usage report
+
+    # Federation settings: show and book the Labs of other In4Labs servers in this one.
+    # Peers by server_name with the URL of their main app (e.g. {'rasp2': 'http://rasp2.local:8000'}),
+    # also as JSON in the environment
+    FEDERATION_PEERS = json.loads(os.environ.get('FEDERATION_PEERS') or '{}')
+    FEDERATION_TOKEN = os.environ.get('FEDERATION_TOKEN') # shared by all the peers, None disables the peers API
+    FEDERATION_TIMEOUT = 2 # seconds to wait for a peer
+    FEDERATION_CACHE_SECONDS = 15 # cache of the peers Labs and availability
 
     # Labs settings
+    LABS_RELOAD_INTERVAL = 10 # seconds between checks of changes in this file
     labs_config = {
-        'server_name': 'rasp1',
+        'server_name': instance_name or 'rasp1',
         'mountings': [{
             'id': '1', 
             'duration': 10, # minutes
@@ -0,0 +1,84 @@
+from sqlalchemy import func, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from in4labs_app import db
+
+
+def upgrade_db():
+    # Lightweight migration of databases created by previous versions: create the
+    # missing tables, add the missing (nullable) columns and create the missing indexes
+    existing = set(inspect(db.engine).get_table_names())
+    missing = [table.name for table in db.metadata.sorted_tables if table.name not in existing]
+    if missing:
+        print('Creating database...' if not existing else f'Creating tables {", ".join(missing)}...')
+    db.create_all()
+    inspector = inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    print(f'Adding column {table.name}.{column.name}...')
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+    booking_indexes = {index['name'] for index in inspect(db.engine).get_indexes('booking')}
+    if 'ux_booking_mounting_date_time' not in booking_indexes:
+        archive_duplicated_bookings()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except IntegrityError as e:
+                # Without the unique indexes the same time slot could be booked twice
+                raise RuntimeError(f'Index {index.name} not created, table {table.name} has '
+                                   f'duplicated rows: {e}') from e
+
+def archive_duplicated_bookings():
+    # Previous versions could book the same time slot twice. The earliest booking is kept and
+    # the others are moved to the archive, so the unique index of the time slots can be created
+    from .app_bp.models import Booking, BookingArchive, LabSession
+    slots = db.session.query(Booking.mounting_id, Booking.date_time, func.min(Booking.id)).group_by(
+        Booking.mounting_id, Booking.date_time
+    ).having(func.count(Booking.id) > 1).all()
+    for mounting_id, date_time, kept_id in slots:
+        duplicates = Booking.query.filter(
+            Booking.mounting_id == mounting_id,
+            Booking.date_time == date_time,
+            Booking.id != kept_id
+        ).all()
+        for booking in duplicates:
+            print(f'Booking {booking.id} (user {booking.user_id}, {booking.lab_name} at {booking.date_time} UTC) '
+                  f'duplicates booking {kept_id}, moved to the archive.')
+            db.session.add(BookingArchive(booking_id=booking.id, user_id=booking.user_id,
+                                          mounting_id=booking.mounting_id, lab_name=booking.lab_name,
+                                          date_time=booking.date_time, entered=False))
+        duplicate_ids = [booking.id for booking in duplicates]
+        LabSession.query.filter(LabSession.booking_id.in_(duplicate_ids)).delete(synchronize_session=False)
+        Booking.query.filter(Booking.id.in_(duplicate_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+def get_insert():
+    # INSERT with ON CONFLICT support of the database
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+def insert_or_ignore(model, values):
+    # INSERT ... ON CONFLICT DO NOTHING, returns the number of inserted rows,
+    # so a conflict is detected in the same statement
+    stmt = get_insert()(model).values(values).on_conflict_do_nothing()
+    result = db.session.execute(stmt)
+    db.session.commit()
+    return result.rowcount
+
+def insert_or_add(model, values, keys):
+    # INSERT ... ON CONFLICT DO UPDATE adding the values to the existing row (counters),
+    # without committing
+    insert = get_insert()
+    stmt = insert(model).values(values)
+    counters = {name: getattr(model, name) + stmt.excluded[name] for name in values if name not in keys}
+    db.session.execute(stmt.on_conflict_do_update(index_elements=keys, set_=counters))
@@ -0,0 +1,138 @@
+import hashlib
+import importlib
+import os
+import threading
+import time
+from types import MappingProxyType
+
+from . import config as config_module
+
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+labs_dir = os.path.join(basedir, 'labs')
+
+
+health_checks = ('port', 'http', 'log')
+
+def check_extra_containers(lab_name, extra_containers):
+    # The extra containers start in parallel, except the ones that depend on others
+    errors = []
+    names = [c['name'] for c in extra_containers]
+    for container in extra_containers:
+        for dependency in container.get('depends_on', ()):
+            if dependency not in names:
+                errors.append(f'Unknown dependency {dependency} of container {container["name"]} in lab {lab_name}.')
+        healthcheck = container.get('healthcheck', {})
+        if healthcheck and not any(check in healthcheck for check in health_checks):
+            errors.append(f'The healthcheck of container {container["name"]} in lab {lab_name} '
+                          f'needs one of: {", ".join(health_checks)}.')
+    # Dependency cycles
+    started = set()
+    pending = {c['name']: set(c.get('depends_on', ())) & set(names) for c in extra_containers}
+    while pending:
+        ready = [name for name, dependencies in pending.items() if dependencies <= started]
+        if not ready:
+            errors.append(f'Dependency cycle between the containers {", ".join(sorted(pending))} in lab {lab_name}.')
+            break
+        for name in ready:
+            started.add(name)
+            del pending[name]
+    return errors
+
+
+class LabsRegistry(object):
+    # Read-only view of Config.labs_config, compiled and validated once:
+    # labs by name and mountings by id, with the Docker settings precomputed
+    def __init__(self, labs_config):
+        self.server_name = labs_config['server_name']
+        # The same in all the workers, for the ETags of the pages showing the labs
+        self.version = hashlib.sha1(repr(labs_config).encode()).hexdigest()
+        errors = []
+
+        mountings = {}
+        host_ports = set()
+        for mounting in labs_config['mountings']:
+            mounting_id = str(mounting['id'])
+            if mounting_id in mountings:
+                errors.append(f'Duplicate mounting id {mounting_id}.')
+            if mounting['host_port'] in host_ports:
+                errors.append(f'Duplicate host_port {mounting["host_port"]} in mounting {mounting_id}.')
+            if 60 % mounting['duration'] != 0:
+                errors.append(f'The duration of mounting {mounting_id} must be a divisor of 60 minutes.')
+            host_ports.add(mounting['host_port'])
+            mountings[mounting_id] = MappingProxyType(dict(mounting, id=mounting_id))
+
+        labs = {}
+        mounting_labs = {mounting_id: [] for mounting_id in mountings}
+        for lab in labs_config['labs']:
+            lab_name = lab['lab_name']
+            mounting_id = str(lab['mounting_id'])
+            if lab_name in labs:
+                errors.append(f'Duplicate lab_name {lab_name}.')
+            if mounting_id not in mountings:
+                errors.append(f'Unknown mounting_id {mounting_id} in lab {lab_name}.')
+                continue
+            instructions_path = os.path.join(labs_dir, lab_name, 'instructions.html')
+            if not os.path.exists(instructions_path):
+                errors.append(f'Missing instructions file {instructions_path}.')
+
+            extra_containers = lab.get('extra_containers', [])
+            errors += check_extra_containers(lab_name, extra_containers)
+
+            mounting = mountings[mounting_id]
+            lab_volumes = {'/dev/bus/usb': {'bind': '/dev/bus/usb', 'mode': 'rw'}}
+            lab_volumes.update(lab.get('volumes', {}))
+            labs[lab_name] = MappingProxyType(dict(
+                lab,
+                mounting_id=mounting_id,
+                mounting=mounting,
+                image_name=f'{lab_name.lower()}:latest',
+                container_prefix=lab_name.lower(),
+                volumes=lab_volumes,
+                ports={'8000/tcp': ('0.0.0.0', mounting['host_port'])},
+                extra_containers=tuple(MappingProxyType(dict(c, depends_on=tuple(c.get('depends_on', ()))))
+                                       for c in extra_containers),
+                instructions_path=instructions_path,
+                instructions_template=f'{lab_name}/instructions.html',
+            ))
+            mounting_labs[mounting_id].append(labs[lab_name])
+
+        if errors:
+            raise ValueError('Invalid labs configuration:\n' + '\n'.join(errors))
+
+        self.labs = MappingProxyType(labs)
+        self.lab_list = tuple(labs.values())
+        self.mountings = MappingProxyType(mountings)
+        self.mounting_labs = MappingProxyType({k: tuple(v) for k, v in mounting_labs.items() if v})
+
+
+registry = LabsRegistry(config_module.Config.labs_config)
+config_mtime = os.path.getmtime(config_module.__file__)
+last_check = time.time()
+reload_lock = threading.Lock()
+
+def get_registry():
+    return registry
+
+def reload_registry_if_changed(interval):
+    # Compile the labs config again when config.py changes, without restarting gunicorn
+    global registry, config_mtime, last_check
+    if time.time() - last_check < interval:
+        return
+    with reload_lock:
+        last_check = time.time()
+        mtime = os.path.getmtime(config_module.__file__)
+        if mtime == config_mtime:
+            return
+        config_mtime = mtime
+        try:
+            new_config = importlib.reload(config_module)
+            new_registry = LabsRegistry(new_config.Config.labs_config)
+        except Exception as e:
+            print(f'Labs configuration not reloaded: {e}')
+            return
+        if new_registry.server_name != registry.server_name:
+            print('Labs configuration not reloaded: server_name cannot change without a restart.')
+            return
+        registry = new_registry
+        print('Labs configuration reloaded.')
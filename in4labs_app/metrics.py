@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+
+from .config import Config
+
+# The gunicorn workers write their metrics in this folder and /metrics adds them up.
+# The variable must be set before importing prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', Config.METRICS_DIR)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, \
+    CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client import multiprocess
+
+
+request_seconds = Histogram('in4labs_request_duration_seconds', 'Request latency by route.',
+                            ['endpoint', 'method', 'status'])
+db_query_seconds = Histogram('in4labs_db_query_duration_seconds', 'Database query latency by statement type.',
+                             ['statement'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+docker_call_seconds = Histogram('in4labs_docker_call_duration_seconds', 'Docker API calls and Lab setup steps.',
+                                ['call'], buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120))
+container_start_seconds = Histogram('in4labs_container_start_seconds', 'Time to run a Lab container until healthy.',
+                                    ['container'], buckets=(.1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60))
+enter_to_ready_seconds = Histogram('in4labs_enter_to_ready_seconds', 'Time from Enter to the Lab web server ready.',
+                                   buckets=(0, .5, 1, 2, 5, 10, 20, 30, 60, 120))
+log_bytes = Counter('in4labs_log_bytes', 'Bytes of Lab container logs captured.')
+threads = Gauge('in4labs_threads', 'Threads of the gunicorn workers.', multiprocess_mode='livesum')
+
+
+@contextmanager
+def observe_docker_call(call):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        docker_call_seconds.labels(call).observe(time.perf_counter() - start_time)
+
+def before_request():
+    g.request_start = time.perf_counter()
+
+def after_request(response):
+    start_time = g.pop('request_start', None)
+    if start_time is not None:
+        endpoint = request.url_rule.endpoint if request.url_rule else 'not_found'
+        request_seconds.labels(endpoint, request.method, response.status_code).observe(
+            time.perf_counter() - start_time)
+    threads.set(threading.active_count())
+    return response
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_time = conn.info['query_start'].pop()
+    statement_type = statement.lstrip().split(' ', 1)[0].upper()
+    db_query_seconds.labels(statement_type).observe(time.perf_counter() - start_time)
+
+def init_app(app, engine):
+    app.before_request(before_request)
+    app.after_request(after_request)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+class SessionsCollector(object):
+    # Lab sessions by status, read from the db when scraped (the same in all the workers)
+    def __init__(self, count_sessions):
+        self.count_sessions = count_sessions
+
+    def collect(self):
+        metric = GaugeMetricFamily('in4labs_lab_sessions', 'Lab sessions by status.', labels=['status'])
+        for status, count in self.count_sessions():
+            metric.add_metric([status], count)
+        yield metric
+
+def render_metrics(count_sessions):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(SessionsCollector(count_sessions))
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+